@@ -74,12 +74,18 @@ class App(TkBrowser):
         else:
             self.app_path = __file__
         self.app_path = os.path.abspath(os.path.dirname(self.app_path))
+        # stores index cache and part snapshots folder, None - disabled
+        self.cache_path = None
+        # columnar ops, resident parts, mmaped stores
+        self.fast = False
 
     def clear_data(self):
         self.sim = None
         self.last_fn = ""
         # store manager
         self.strfm = None
+        # decoded images
+        self.imgcache = petka.ImageCache()
         # save
         self.save = None
         self.last_savefn = ""
@@ -327,21 +333,18 @@ class App(TkBrowser):
         return self.fmt_hl_rec(self.sim.scn_idx, "scenes", rec_id, full, "scn")
 
     def find_path_name(self, key):
-        for name_id, name in enumerate(self.sim.namesord):
-            if name == key:
-                return "/names/{}".format(name_id)
+        if key in self.sim.names_pos:
+            return "/names/{}".format(self.sim.names_pos[key])
         return "/no_name/{}".format(key)
 
     def find_path_invntr(self, key):
-        for inv_id, name in enumerate(self.sim.invntrord):
-            if name == key:
-                return "/invntr/{}".format(inv_id)
+        if key in self.sim.invntr_pos:
+            return "/invntr/{}".format(self.sim.invntr_pos[key])
         return "/no_invntr/{}".format(key)
 
     def find_path_cast(self, key):
-        for cast_id, name in enumerate(self.sim.castsord):
-            if name == key:
-                return "/casts/{}".format(cast_id)
+        if key in self.sim.casts_pos:
+            return "/casts/{}".format(self.sim.casts_pos[key])
         return "/no_casts/{}".format(key)
 
     def fmt_hl_msg(self, msg_id, full = False):
@@ -387,10 +390,9 @@ class App(TkBrowser):
             self.add_info("  Files:         " + fmt_hl("/files",
                 len(self.strfm.strtable)) + "\n")
             scn = hlesc(self.sim.start_scene)
-            for scene in self.sim.scenes:
-                if scene.name == self.sim.start_scene:
-                    scn = self.fmt_hl_scene(scene.idx, True)
-                    break
+            if self.sim.start_scene in self.sim.scn_names:
+                scn = self.fmt_hl_scene(self.sim.scn_names[
+                    self.sim.start_scene][0].idx, True)
             self.add_info("  Start scene:   {}\n".format(scn))
             self.add_info("\n")
             self.add_info("  " + fmt_hl("/opcodes", "Opcodes") + "\n")
@@ -496,14 +498,8 @@ class App(TkBrowser):
         self.switch_view(0)
         if self.last_path[:1] != ("parts",):
             self.update_gui("Parts ({})".format(len(self.sim.parts)))
-            for name in self.sim.parts:
-                pnum = name[5:]
-                cnum = pnum.split("Chapter", 1)
-                if len(cnum) > 1:
-                    pnum = int(cnum[0].strip(), 10)
-                    cnum = int(cnum[1].strip(), 10)
-                else:
-                    cnum = 0
+            for name, (pnum, cnum) in zip(self.sim.parts, \
+                    self.sim.part_ids()):
                 part_id = "{}.{}".format(pnum, cnum)
                 self.insert_lb_act(name, ["parts", part_id], part_id)
             if len(self.sim.parts) == 0:
@@ -543,6 +539,8 @@ class App(TkBrowser):
         else:
             try:
                 self.clear_hist()
+                # part stores will be detached
+                self.imgcache.drop_mapped()
                 self.sim.open_part(part[0], part[1])
                 self.path_info_outline()
             except:
@@ -599,7 +597,7 @@ class App(TkBrowser):
             try:
                 if fn[-4:].lower() == ".bmp":
                     self.add_info("<b>BMP image</b>: ")
-                    bmpf = self.sim.fman.read_file_stream(fn)
+                    bmpf = self.sim.fman.read_file_stream(fn, True)
                     bmp = petka.BMPLoader()
                     bmp.load_info(bmpf)
                     if bmp.image:
@@ -614,9 +612,13 @@ class App(TkBrowser):
                             format(bmp.width, bmp.height))
                 elif fn[-4:].lower() == ".flc":
                     self.add_info("<b>FLC animation</b>: ")
-                    flcf = self.sim.fman.read_file_stream(fn)
+                    flcf = self.sim.fman.read_file_stream(fn, True)
                     flc = petka.FLCLoader()
-                    flc.load_info(flcf)
+                    try:
+                        flc.load_header(flcf)
+                    except:
+                        flcf.seek(0)
+                        flc.load_info(flcf)
                     if flc.image:
                         # PIL
                         self.add_info("Python Imaging\n")
@@ -626,33 +628,38 @@ class App(TkBrowser):
                                 flc.image.size[0], flc.image.size[1],
                                 flc.frame_num, flc.image.info["duration"]))
                     else:
-                        self.add_info("internal FLC loader\n  "\
+                        self.add_info("internal FLC loader\n"\
                             "  Mode:   P\n  Size:   {}x{}\n"\
-                            "  Frames: {}\nDelay: {}".\
+                            "  Frames: {}\n  Delay:  {}".\
                             format(flc.width, flc.height, \
                                 flc.frame_num, flc.delay))
+                elif fn[-4:].lower() in [".leg", ".off"]:
+                    self.add_info("<b>LEG/OFF data</b>: ")
+                    legf = petka.LEGLoader()
+                    legf.load_header(self.sim.fman.read_file_stream(fn, True))
+                    self.add_info("{} frame(s)".format(legf.frame_num))
+                elif fn[-4:].lower() == ".msk":
+                    self.add_info("<b>MSK data</b>: ")
+                    mskf = petka.MSKLoader()
+                    mskf.load_header(self.sim.fman.read_file_stream(fn, True))
+                    self.add_info("{} record(s)\n  bound: {}, {} - {}, {}".\
+                        format(mskf.rect_num, *mskf.bound))
                 else:
                     self.add_info("No information availiable")
             except:
                 self.add_info("Error loading {} - \"{}\" \n\n{}".\
                     format(res_id, hlesc(fn), hlesc(traceback.format_exc())))
 
-            def usedby(lst):
-                for idx, rec in enumerate(lst):
-                    ru = False
-                    for act in rec.acts:
-                        if ru: break
-                        for op in act.ops:
-                            if res_id == op.op_arg1:
-                                self.add_info("  " +
-                                    self.fmt_hl_obj_scene(rec.idx, True) + "\n")
-                                ru = True
-                                break
+            def usedby(isobj):
+                for rec in self.sim.xref_res.get(res_id, []):
+                    if (self.sim.obj_idx.get(rec.idx) is rec) == isobj:
+                        self.add_info("  " +
+                            self.fmt_hl_obj_scene(rec.idx, True) + "\n")
 
             self.add_info("\n\n<b>Used by objects</b>:\n")
-            usedby(self.sim.objects)
+            usedby(True)
             self.add_info("\n<b>Used by scenes</b>:\n")
-            usedby(self.sim.scenes)
+            usedby(False)
             self.add_info("\nFile: {}\n".format(self.fmt_hl_file(fn)))
 
 
@@ -662,21 +669,24 @@ class App(TkBrowser):
 
     def path_res_view(self, res_id):
         fn = self.sim.res[res_id]
+        dataf = None
         try:
-            dataf = self.sim.fman.read_file_stream(fn)
-            if fn[-4:].lower() == ".bmp":
-                bmp = petka.BMPLoader()
-                bmp.load_data(dataf)
-                self.main_image = \
-                    self.make_image(bmp)
-                self.switch_view(1)
-                self.update_canvas()
-            elif fn[-4:].lower() == ".flc":
-                flcf = self.sim.fman.read_file_stream(fn)
-                flc = petka.FLCLoader()
-                flc.load_data(dataf)
+            img = None
+            if fn[-4:].lower() in [".bmp", ".flc"]:
+                # decoded images shared by history moves
+                key = self.sim.fman.file_key(fn)
+                img = self.imgcache.get(key)
+            if img is None and fn[-4:].lower() in [".bmp", ".flc"]:
+                dataf = self.sim.fman.read_file_stream(fn, True)
+                if fn[-4:].lower() == ".bmp":
+                    img = petka.BMPLoader()
+                else:
+                    img = petka.FLCLoader()
+                img.load_data(dataf)
+                self.imgcache.put(key, img)
+            if img is not None:
                 self.main_image = \
-                    self.make_image(flc)
+                    self.make_image(img)
                 self.switch_view(1)
                 self.update_canvas()
             else:
@@ -711,6 +721,10 @@ class App(TkBrowser):
         for ft in ftk:
             self.add_info("  <a href=\"/res/flt/{}\">{}</a>: {}\n".format(
                 ft, ft, fts[ft]))
+        ic = self.imgcache
+        self.add_info("\nImage cache: {} image(s), {} KB of {} KB\n"\
+            "  hits: {}, misses: {}\n".format(len(ic.items), ic.size // 1024,
+                ic.budget // 1024, ic.hits, ic.misses))
         self.select_lb_item(None)
         return True
 
@@ -838,12 +852,9 @@ class App(TkBrowser):
             if isobj:
                 # search where object used
                 self.add_info("\n<b>Refered by scenes</b>:\n")
-                for scn in self.sim.scenes:
-                    for ref in scn.refs:
-                        if ref[0].idx == rec.idx:
-                            self.add_info("  " +
-                                self.fmt_hl_scene(scn.idx, True) + "\n")
-                            break
+                for scn in self.sim.xref_scenes.get(rec.idx, []):
+                    self.add_info("  " +
+                        self.fmt_hl_scene(scn.idx, True) + "\n")
             else:
                 if rec.refs is None:
                     self.add_info("\nNo references\n")
@@ -931,8 +942,7 @@ class App(TkBrowser):
             # messages used by this object
             if isobj:
                 wasmsg = False
-                for msg in self.sim.msgs:
-                    if msg.obj.idx != rec.idx: continue
+                for msg in self.sim.xref_msgs.get(rec.idx, []):
                     if not wasmsg:
                         self.add_info("\n<b>Messages</b>:\n")
                         wasmsg = True
@@ -941,16 +951,17 @@ class App(TkBrowser):
             oplst = {}
             # objects can use this objects in TALK opcode
             wasmsg = False
-            for obj2 in self.sim.objects + self.sim.scenes:
+            # first op in each handler
+            acts = set()
+            for obj2, idx, oidx in self.sim.xref_ops.get(rec.idx, []):
                 if obj2.idx == rec.idx: continue
-                for idx, act in \
-                        enumerate(obj2.acts):
-                    for oidx, op in enumerate(act.ops):
-                        if op.op_ref == rec.idx:
-                            arr = oplst.get(op.op_code, [])
-                            arr.append((obj2.idx, act.act_op, idx))
-                            oplst[op.op_code] = arr
-                            break
+                if (id(obj2), idx) in acts: continue
+                acts.add((id(obj2), idx))
+                act = obj2.acts[idx]
+                op = act.ops[oidx]
+                arr = oplst.get(op.op_code, [])
+                arr.append((obj2.idx, act.act_op, idx))
+                oplst[op.op_code] = arr
 
             klst = list(petka.OPCODES.keys())
             klst.sort()
@@ -1023,9 +1034,8 @@ class App(TkBrowser):
                     format(hlesc(self._t(self.sim.names[name], "name"))))
             # search for objects
             self.add_info("\n<b>Applied for</b>:\n")
-            for obj in self.sim.objects:
-                if obj.name == name:
-                    self.add_info("  " + self.fmt_hl_obj(obj.idx, True) + "\n")
+            for obj in self.sim.obj_names.get(name, []):
+                self.add_info("  " + self.fmt_hl_obj(obj.idx, True) + "\n")
         return self.path_std_items(path, 1, "Names", "name", "obj",
             self.sim.names, self.sim.namesord, 0, info)
 
@@ -1043,9 +1053,8 @@ class App(TkBrowser):
                     format(hlesc(self._t(self.sim.invntr[name], "inv"))))
             # search for objects
             self.add_info("<b>Applied for</b>:\n")
-            for obj in self.sim.objects:
-                if obj.name == name:
-                    self.add_info("  " + self.fmt_hl_obj(obj.idx, True) + "\n")
+            for obj in self.sim.obj_names.get(name, []):
+                self.add_info("  " + self.fmt_hl_obj(obj.idx, True) + "\n")
         return self.path_std_items(path, 1, "Invntr", "invntr", "obj",
             self.sim.invntr, self.sim.invntrord, 0, info)
 
@@ -1072,9 +1081,8 @@ class App(TkBrowser):
             self.add_info("  " + hl + "\n\n")
             # search for objects
             self.add_info("<b>Applied for</b>:\n")
-            for idx, obj in enumerate(self.sim.objects):
-                if obj.name == name:
-                    self.add_info("  " + self.fmt_hl_obj(obj.idx, True) + "\n")
+            for obj in self.sim.obj_names.get(name, []):
+                self.add_info("  " + self.fmt_hl_obj(obj.idx, True) + "\n")
         return self.path_std_items(path, 1, "Cast", "cast", "obj",
             self.sim.casts, self.sim.castsord, 0, info)
 
@@ -1140,14 +1148,9 @@ class App(TkBrowser):
                     self.add_info("\n<i>Translated:</i>\n{}\n".\
                         format(hlesc(self._t(msg.name, "msg"))))
                 self.add_info("\n<b>Used by dialog groups</b>:\n")
-                for grp in self.sim.dlgs:
-                    for act in grp.acts:
-                        for dlg in act.dlgs:
-                            for op in dlg.ops:
-                                if not op.msg: continue
-                                if op.msg.idx == msg.idx and op.opcode == 7:
-                                    self.add_info("  " +
-                                        self.fmt_hl_dlg(grp.idx, True) + "\n")
+                for grp in self.sim.xref_msgdlg.get(msg.idx, []):
+                    self.add_info("  " +
+                        self.fmt_hl_dlg(grp.idx, True) + "\n")
 
         if self.last_path[:1] != ("msgs",):
             self.update_gui("Messages ({})".format(len(self.sim.msgs)))
@@ -1298,34 +1301,26 @@ class App(TkBrowser):
                         self.add_info("        {}{}{}{}\n".\
                             format(opcode, oparg, opref, cmt))
 
-            def usedby(lst, hl):
+            def usedby(idx, hl):
                 hdr = False
-                for rec in lst:
-                    if grp.idx == rec.idx:
-                        # linked object woth same id
-                        if not hdr:
-                            self.add_info(hl)
-                            hdr = True
-                        self.add_info("  linked " +
-                            self.fmt_hl_obj_scene(rec.idx, True) + "\n")
+                # linked object woth same id
+                linked = idx.get(grp.idx)
+                if linked:
+                    self.add_info(hl)
+                    hdr = True
+                    self.add_info("  linked " +
+                        self.fmt_hl_obj_scene(linked.idx, True) + "\n")
+                for rec in self.sim.xref_dlgs.get(grp.idx, []):
+                    if rec is linked or idx.get(rec.idx) is not rec:
                         continue
-                    ru = False
-                    for act in rec.acts:
-                        if ru: break
-                        for op in act.ops:
-                            if op.op_code == 0x11 and \
-                                    op.op_ref == grp.idx: # DIALOG
-                                if not hdr:
-                                    self.add_info(hl)
-                                    hdr = True
-                                self.add_info("  " +
-                                    self.fmt_hl_obj_scene(rec.idx, True) + "\n")
-                                ru = True
-                                break
-                            #print(op_id, op_code, op_res, op4, op5)
-
-            usedby(self.sim.objects, "\n<b>Used by objects</b>:\n")
-            usedby(self.sim.scenes, "\n<b>Used by scenes</b>:\n")
+                    if not hdr:
+                        self.add_info(hl)
+                        hdr = True
+                    self.add_info("  " +
+                        self.fmt_hl_obj_scene(rec.idx, True) + "\n")
+
+            usedby(self.sim.obj_idx, "\n<b>Used by objects</b>:\n")
+            usedby(self.sim.scn_idx, "\n<b>Used by scenes</b>:\n")
         return True
 
     def path_opcodes(self, path):
@@ -1334,7 +1329,6 @@ class App(TkBrowser):
         self.switch_view(0)
         keys = None
         def keyslist():
-            opstat = {} # opcodes count
             acstat = {} # handlers count
             dastat = {} # dialog handlers count
             keys = list(petka.OPCODES.keys())
@@ -1343,11 +1337,10 @@ class App(TkBrowser):
                     acstat[act.act_op] = acstat.get(act.act_op, 0) + 1
                     if act.act_op not in keys:
                         keys.append(act.act_op)
-                    for op in act.ops:
-                        opstat[op.op_code] = opstat.get(op.op_code,
-                            0) + 1
-                        if op.op_code not in keys:
-                            keys.append(op.op_code)
+            opstat = self.sim.count_ops() # opcodes count
+            for key in opstat:
+                if key not in keys:
+                    keys.append(key)
             for grp in self.sim.dlgs:
                 for act in grp.acts:
                     dastat[act.opcode] = dastat.get(act.opcode, 0) + 1
@@ -1410,9 +1403,8 @@ class App(TkBrowser):
                 for aidx, act in enumerate(rec.acts):
                     if act.act_op == opcode:
                         acts.append([rec.idx, aidx])
-                    for oidx, op in enumerate(act.ops):
-                        if op.op_code == opcode:
-                            ops.append([rec.idx, aidx, oidx])
+            for rec, aidx, oidx in self.sim.find_ops(op_code = opcode):
+                ops.append([rec.idx, aidx, oidx])
             for grp in self.sim.dlgs:
                 for aidx, act in enumerate(grp.acts):
                     if act.opcode == opcode and act.ref not in dacts:
@@ -1622,27 +1614,18 @@ class App(TkBrowser):
                     initialdir = self.strfm.root, mustexist = True)
                 if not sdir: return
                 # extract store to sdir
-                fd, _, _, strlst = self.strfm.strfd[stid]
                 self.clear_info()
-                for fname, _, pos, ln in strlst:
-                    try:
-                        self.add_info("  \"{}\" - {} bytes\n".
-                            format(hlesc(fname), ln))
-                        np = sdir
-                        for elem in fname.split("/"):
-                            np = os.path.join(np, elem)
-                        # check folder
-                        bn = os.path.dirname(np)
-                        if not os.path.exists(bn):
-                            os.makedirs(bn)
-                        f = open(np, "wb")
-                        fd.seek(pos)
-                        f.write(fd.read(ln))
-                        f.close()
-                    except:
-                        self.add_info("Error extracting \"{}\"\n\n{}".\
-                            format(hlesc(fname), hlesc(traceback.format_exc())))
-                        return
+                try:
+                    cnt, total = self.strfm.extract_store(stid, sdir)
+                except:
+                    self.add_info("Error extracting to \"{}\"\n\n{}".\
+                        format(hlesc(sdir), hlesc(traceback.format_exc())))
+                    return
+                for fname, _, pos, ln in self.strfm.strfd[stid][3]:
+                    self.add_info("  \"{}\" - {} bytes\n".
+                        format(hlesc(fname), ln))
+                self.add_info("\nExtracted {} files, {} bytes\n".format(cnt,
+                    total))
             self.curr_state["btnext"] = self.add_toolbtn("Extract STR", ext_str)
             self.curr_state["btnsort"] = self.add_toolgrp("Sort by",
                 "strs.sortfiles", {0: "order", 1: "filename"}, upd_strs)
@@ -1692,7 +1675,7 @@ class App(TkBrowser):
                         idx + 1, self.fmt_hl_file(fn)))
             else:
                 try:
-                    self.strfm.read_file(fnl)
+                    self.strfm.read_file(fnl, True)
                 except:
                     self.add_info("<b>File</b> \"{}\" not found\n\n".\
                         format(hlesc(fnl)))
@@ -1785,7 +1768,7 @@ class App(TkBrowser):
 
                 if fnl[-4:] in [".leg", ".off"]:
                     legf = petka.LEGLoader()
-                    legf.load_data(self.strfm.read_file_stream(fnl))
+                    legf.load_data(self.strfm.read_file_stream(fnl, True))
                     self.add_info("\n<b>LEG/OFF data</b>: {} frame(s)\n".format(
                         len(legf.coords)))
                     fmt = "  " + fmt_dec(len(legf.coords)) + ") {}, {}\n"
@@ -1794,7 +1777,7 @@ class App(TkBrowser):
 
                 if fnl[-4:] == ".msk":
                     mskf = petka.MSKLoader()
-                    mskf.load_data(self.strfm.read_file_stream(fnl))
+                    mskf.load_data(self.strfm.read_file_stream(fnl, True))
                     self.add_info("\n<b>MSK data</b>: {} record(s)\n".format(
                         len(mskf.rects)))
                     self.add_info("  bound: {}, {} - {}, {}\n".format(
@@ -1809,7 +1792,12 @@ class App(TkBrowser):
 
                 if fnl[-4:] == ".flc":
                     flcf = petka.FLCLoader()
-                    flcf.load_info(self.strfm.read_file_stream(fnl))
+                    flcs = self.strfm.read_file_stream(fnl, True)
+                    try:
+                        flcf.load_header(flcs)
+                    except:
+                        flcs.seek(0)
+                        flcf.load_info(flcs)
                     if flcf.image:
                         # PIL
                         self.add_info("\n<b>FLC data</b> (pil)\n")
@@ -1821,7 +1809,7 @@ class App(TkBrowser):
                     else:
                         self.add_info("\n<b>FLC data</b> (internal)\n")
                         self.add_info("  Mode:   P\n  Size:   {}x{}\n"\
-                            "  Frames: {}\nDelay: {}".\
+                            "  Frames: {}\n  Delay:  {}".\
                             format(flcf.width, flcf.height, \
                                 flcf.frame_num, flcf.delay))
 
@@ -1897,11 +1885,8 @@ class App(TkBrowser):
                 for idx, obj in enumerate(self.save.objects):
                     self.add_info(fmt.format(idx + 1, obj["name"],
                         obj["alias"]))
-                    fndobj = None
-                    for sobj in self.sim.objects + self.sim.scenes:
-                        if sobj.name == obj["name"]:
-                            fndobj = sobj
-                            break
+                    fndobj = (self.sim.obj_names.get(obj["name"]) or
+                        self.sim.scn_names.get(obj["name"]) or [None])[0]
                     if fndobj:
                         self.add_info("    " +
                             self.fmt_hl_obj_scene(fndobj.idx, True) + "\n")
@@ -2129,7 +2114,13 @@ class App(TkBrowser):
         self.clear_data()
         try:
             self.sim = petka.Engine()
-            self.sim.load_data(folder, "cp1251")
+            if self.fast:
+                self.sim.columnar = True
+                self.sim.resident = 4
+            self.sim.snapdir = self.cache_path
+            self.sim.load_data(folder, "cp1251",
+                petka.FileManager(folder, usemmap = self.fast,
+                    idxcache = self.cache_path))
             self.strfm = self.sim.fman
             self.sim.open_part(0, 0)
             return True
@@ -2160,7 +2151,8 @@ class App(TkBrowser):
     def open_str_from(self, fn):
         self.clear_data()
         try:
-            self.strfm = petka.FileManager(os.path.dirname(fn))
+            self.strfm = petka.FileManager(os.path.dirname(fn),
+                usemmap = self.fast, idxcache = self.cache_path)
             self.strfm.load_store(os.path.basename(fn))
             return True
         except:
@@ -2202,6 +2194,7 @@ class App(TkBrowser):
                 if self.save.part != self.sim.curr_part:
                     # load
                     print("DEBUG: change part {}".format(self.save.part))
+                    self.imgcache.drop_mapped()
                     self.sim.open_part(self.save.part, 0)
                     f.seek(0)
                     self.save.load_data(f, self.sim.curr_part,
@@ -2522,6 +2515,12 @@ def main():
         elif argv[0] == "-dump": # dump to folder
             app.start_act.append(["dump", argv[1]])
             argv = argv[2:]
+        elif argv[0] == "-c": # cache folder
+            app.cache_path = argv[1]
+            argv = argv[2:]
+        elif argv[0] == "-fast": # columnar, resident parts, mmap
+            app.fast = True
+            argv = argv[1:]
         else:
             app.start_act.append(["open", argv[0]])
             argv = argv[1:]
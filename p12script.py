@@ -4,10 +4,19 @@
 # romiq.kh@gmail.com, 2014
 
 import os, sys
+import re
 import traceback
 import argparse
 import io
 import hashlib
+import time
+import struct
+import gc
+import tracemalloc
+import pickle
+import collections
+import contextlib
+import concurrent.futures
 
 import petka
 import petka.engine
@@ -15,8 +24,21 @@ import petka.engine
 APPNAME = "P1&2 Compiler and decompiler"
 VERSION = "v0.3h 2015-01-12"
 
+# incremental compile cache, in output folder
+INC_CACHE = "script.inc"
+INC_VERSION = 1
+
 class ScriptSyntaxError(Exception): pass
 
+# source token: comment, [prefix]"string" with closing quote or up to end
+# of line, plain item
+TOKEN_RE = re.compile(r'[ \t]*(?:(#)|([^ \t"#]*)"((?:[^"\\]|\\.)*)'\
+    r'(?:(")|\\?$)|([^ \t"#]+))', re.S)
+TOKEN_ESC_RE = re.compile(r'\\(.)', re.S)
+TOKEN_SPACE_RE = re.compile(r'[ \t]+')
+# whitespace str.split() splits on, but tokens do not
+TOKEN_OTHERSPACE_RE = re.compile(r'[^\S \t\n]|\r(?!\n)')
+
 def find_in_folder(folder, name, ifnot = True):
     for item in os.listdir(folder):
         if item.upper() == name.upper():
@@ -26,15 +48,94 @@ def find_in_folder(folder, name, ifnot = True):
     else:
         return None
 
+# number format cache, calls func for new values
+class FmtCache(dict):
+    def __init__(self, func):
+        dict.__init__(self)
+        self.func = func
+
+    def __missing__(self, key):
+        value = self[key] = self.func(key)
+        return value
+
+# write lines from generator, encode in large chunks
+def write_lines(lines, stream, enc = None, chunk = 4096):
+    if stream is None:
+        for line in lines:
+            print(line)
+        return
+    enc = enc or "UTF-8"
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) >= chunk:
+            buf.append("")
+            stream.write("\n".join(buf).encode(enc))
+            buf = []
+    if buf:
+        buf.append("")
+        stream.write("\n".join(buf).encode(enc))
+
 class P12Compiler:
     def __init__(self):
-        pass
+        # identificator -> value used, while compiling block
+        self.trackdeps = None
+        # stage -> seconds, filled by compile_script/compile_dialog
+        self.timings = {}
+
+    def timed(self, stage, func, *args):
+        tm = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0) + \
+                time.perf_counter() - tm
 
     # =======================================================================
     # compiler utils
     # =======================================================================
 
     def tokenizer(self, source, enc):
+        # decode once, lines split by regex scanner
+        text = str(source.read(), enc or "UTF-8")
+        token_match = TOKEN_RE.match
+        esc_sub = TOKEN_ESC_RE.sub
+        space_split = TOKEN_SPACE_RE.split
+        # builtin split is safe only for space and tab
+        strsplit = not TOKEN_OTHERSPACE_RE.search(text)
+        for lineno, line in enumerate(io.StringIO(text), 1):
+            line = line.strip()
+            if "\"" not in line:
+                # no strings, plain items until comment
+                line = line.split("#", 1)[0]
+                if strsplit:
+                    yield lineno, line.split()
+                else:
+                    yield lineno, [item for item in space_split(line) \
+                        if item]
+                continue
+            nline = []
+            pos = 0
+            while True:
+                m = token_match(line, pos)
+                if m is None or m.group(1):
+                    break
+                pos = m.end()
+                prefix, value, closed, item = m.group(2, 3, 4, 5)
+                if item is not None:
+                    nline.append(item)
+                    continue
+                value = esc_sub(r"\1", value)
+                if closed and not prefix:
+                    nline.append(value)
+                elif closed:
+                    nline.append(prefix + "\"" + value + "\"")
+                else:
+                    nline.append(prefix + "\"" + value)
+            yield lineno, nline
+
+    def tokenizer_ref(self, source, enc):
+        # char by char tokenizer, reference for tokenizer
         for lineno, line in enumerate(source.readlines(), 1):
             line = line.decode(enc or "UTF-8").strip()
             # eliminate comment
@@ -143,7 +244,38 @@ class P12Compiler:
                 self.usedid[ident][0], value))
 
     def getidentvalue(self, ident):
-        return self.usedid[ident][1]
+        value = self.usedid[ident][1]
+        if self.trackdeps is not None:
+            self.trackdeps[ident] = value
+        return value
+
+    def depschanged(self, deps):
+        # identificator values differ from used for cached block
+        for ident, value in deps.items():
+            if ident not in self.usedid or self.usedid[ident][1] != value:
+                return True
+        return False
+
+    def rebase(self, citem, delta):
+        # copy of parsed block moved by delta lines
+        if delta == 0:
+            return citem
+        item = dict(citem)
+        item["lineno"] += delta
+        if item["ref"] is not None:
+            item["ref"] = [[ref[0] + delta] + ref[1:] for ref in item["ref"]]
+        item["acts"] = []
+        for act in citem["acts"]:
+            act = dict(act)
+            act["lineno"] += delta
+            ops = []
+            for op in act["ops"]:
+                op = dict(op)
+                op["lineno"] += delta
+                ops.append(op)
+            act["ops"] = ops
+            item["acts"].append(act)
+        return item
 
     def checkident(self, ident, name, lineno):
         if ident.upper() in self.reservedid:
@@ -186,7 +318,9 @@ class P12Compiler:
     # =======================================================================
 
     def compile_script(self, source, destfolder, enc = None, \
-            st_scr = None, st_bkg = None, st_res = None):
+            st_scr = None, st_bkg = None, st_res = None, cache = None):
+        # cache - dict of OBJ/SCENE blocks by content hash from previous
+        # compile, updated for incremental compile
 
         pe = petka.Engine()
         pe.init_empty("cp1251")
@@ -215,7 +349,29 @@ class P12Compiler:
         self.reservedid = ["THIS", "OBJ", "ENDOBJ", "SCENE", "ENDSCENE", \
             "RES", "REF", "ON", "ENDON"] + list(revOPS.keys())
 
-        for lineno, tokens in self.tokenizer(source, enc):
+        lines = self.timed("tokenize", list, self.tokenizer(source, enc))
+        # start line -> (end line, content hash) of OBJ/SCENE blocks
+        blocks = {}
+        if cache is not None:
+            start = None
+            for idx, (lineno, tokens) in enumerate(lines):
+                if len(tokens) == 0:
+                    continue
+                cmd = tokens[0].upper()
+                if start is None:
+                    if cmd == "OBJ" or cmd == "SCENE":
+                        start = idx
+                        blocktp = cmd
+                elif cmd == "END" + blocktp and len(tokens) == 1:
+                    key = hashlib.md5(repr([item[1] for item in \
+                        lines[start:idx + 1]]).encode("UTF-8")).hexdigest()
+                    blocks[start] = (idx, key)
+                    start = None
+
+        idx = 0
+        while idx < len(lines):
+            lineno, tokens = lines[idx]
+            idx += 1
             if len(tokens) == 0:
                 continue
             if mode == 0:
@@ -255,7 +411,22 @@ class P12Compiler:
                                 tokens[2]))
                     compitem = {"tp": cmd, "lineno": lineno, \
                         "ident": tokens[1], "num": num, \
-                        "name": tokens[3], "ref": None, "acts": []}
+                        "name": tokens[3], "ref": None, "acts": [], \
+                        "key": None}
+                    end, key = blocks.get(idx - 1, (None, None))
+                    if key is not None and key in cache:
+                        # same block parsed before, skip to end
+                        compitem = self.rebase(cache[key]["item"], \
+                            lineno - cache[key]["item"]["lineno"])
+                        if cmd == "OBJ":
+                            compobj.append(compitem)
+                        else:
+                            compscene.append(compitem)
+                        compitem = None
+                        mode = 0
+                        idx = end + 1
+                        continue
+                    compitem["key"] = key
                 else:
                     raise ScriptSyntaxError("Error at {}: unknown syntax "\
                         "\"{}\"".format(lineno, cmd))
@@ -452,13 +623,32 @@ class P12Compiler:
                 item.acts.append(onrec)
             return item
 
+        def makerefs(citem, scenerec):
+            scenerec.refs = []
+            for ref in citem["ref"]:
+                fmt = [("REF object", self.check16, True)]
+                for i in range(5):
+                    fmt.append(("REF argument {}".format(i + 1), \
+                        self.check32, True))
+                argnum = self.convertargs(fmt, ref[1:], ref[0])
+                # build REF
+                if argnum[0] not in pe.obj_idx:
+                    raise ScriptSyntaxError("Error at {}: referenced "
+                        "object 0x{:x} not found".\
+                        format(ref[0], argnum[0]))
+                scenerec.refs.append([pe.obj_idx[argnum[0]], argnum[1],
+                     argnum[2],  argnum[3],  argnum[4],  argnum[5]])
+
+        if cache is not None:
+            return self.compile_blocks(pe, compobj, compscene, makerec,
+                makerefs, destfolder, st_scr, st_bkg, cache)
+
         for citem in compobj:
             objrec = makerec(citem)
             pe.objects.append(objrec)
             pe.obj_idx[objrec.idx] = objrec
 
         # second stage - SCENE
-        backgrnd = []
         num_bkg = 0
         for citem in compscene:
             scenerec = makerec(citem)
@@ -466,29 +656,15 @@ class P12Compiler:
             pe.scenes.append(scenerec)
 
             if citem["ref"] is not None:
-                scenerec.refs = []
                 num_bkg += 1
-                for ref in citem["ref"]:
-                    fmt = [("REF object", self.check16, True)]
-                    for i in range(5):
-                        fmt.append(("REF argument {}".format(i + 1), \
-                            self.check32, True))
-                    argnum = self.convertargs(fmt, ref[1:], ref[0])
-                    # build REF
-                    if argnum[0] not in pe.obj_idx:
-                        raise ScriptSyntaxError("Error at {}: referenced "
-                            "object 0x{:x} not found".\
-                            format(lineno, argnum[0]))
-                    scenerec.refs.append([pe.obj_idx[argnum[0]], argnum[1],
-                         argnum[2],  argnum[3],  argnum[4],  argnum[5]])
-
+                makerefs(citem, scenerec)
 
         if destfolder is not None:
             f = open(os.path.join(destfolder, "backgrnd.bg"), "wb")
         else:
             f = st_bkg
         try:
-            pe.write_backgrnd(f)
+            self.timed("serialize", pe.write_backgrnd, f)
         finally:
             if destfolder is not None:
                 f.close()
@@ -499,7 +675,7 @@ class P12Compiler:
         else:
             f = st_scr
         try:
-            pe.write_script(f)
+            self.timed("serialize", pe.write_script, f)
         finally:
             if destfolder is not None:
                 f.close()
@@ -507,6 +683,72 @@ class P12Compiler:
             format(len(pe.objects), len(pe.scenes)))
 
 
+    def compile_blocks(self, pe, compobj, compscene, makerec, makerefs,
+            destfolder, st_scr, st_bkg, cache):
+        # incremental second stage, records of blocks with same content and
+        # identificator values reused
+        blocks = {}
+        recs = []
+        bkgs = []
+        reused = 0
+        for citem in compobj + compscene:
+            entry = cache.get(citem["key"])
+            if entry and not self.depschanged(entry["deps"]) and \
+                    all([num in pe.obj_idx for num in entry["refobjs"]]):
+                reused += 1
+                if citem["tp"] == "OBJ":
+                    pe.obj_idx[citem["num"]] = \
+                        petka.engine.ScrObject(citem["num"], citem["name"])
+            else:
+                self.trackdeps = {}
+                try:
+                    rec = makerec(citem)
+                    if citem["tp"] == "OBJ":
+                        pe.obj_idx[rec.idx] = rec
+                    if citem["tp"] == "SCENE" and citem["ref"] is not None:
+                        makerefs(citem, rec)
+                    entry = {"item": citem, "deps": self.trackdeps,
+                        "rec": pe.pack_rec(rec), "bkg": None, "refobjs": []}
+                    if citem["tp"] == "SCENE" and citem["ref"] is not None:
+                        entry["bkg"] = pe.pack_bkg(rec)
+                        entry["refobjs"] = [ref[0].idx for ref in rec.refs]
+                finally:
+                    self.trackdeps = None
+            if citem["key"] is not None:
+                blocks[citem["key"]] = entry
+            recs.append(entry["rec"])
+            if entry["bkg"] is not None:
+                bkgs.append(entry["bkg"])
+
+        if destfolder is not None:
+            f = open(os.path.join(destfolder, "backgrnd.bg"), "wb")
+        else:
+            f = st_bkg
+        try:
+            self.timed("serialize", f.write,
+                petka.engine.SCR_NUM.pack(len(bkgs)) + b"".join(bkgs))
+        finally:
+            if destfolder is not None:
+                f.close()
+        print("BACKGRND.BG saved: {} items".format(len(bkgs)))
+
+        if destfolder is not None:
+            f = open(os.path.join(destfolder, "script.dat"), "wb")
+        else:
+            f = st_scr
+        try:
+            self.timed("serialize", f.write, petka.engine.SCR_HDR.pack(
+                len(compobj), len(compscene)) + b"".join(recs))
+        finally:
+            if destfolder is not None:
+                f.close()
+        print("SCRIPT.DAT saved: {} objects, {} scenes".\
+            format(len(compobj), len(compscene)))
+        print("Incremental: {} of {} records reused".format(reused,
+            len(recs)))
+        cache.clear()
+        cache.update(blocks)
+
     # =======================================================================
     # compile DIALOGUE.FIX
     # =======================================================================
@@ -546,7 +788,8 @@ class P12Compiler:
         # dlgop count
         compdlgops = 0
 
-        for lineno, tokens in self.tokenizer(source, enc):
+        for lineno, tokens in self.timed("tokenize", list,
+                self.tokenizer(source, enc)):
             if len(tokens) == 0:
                 continue
             if mode == 0:
@@ -705,7 +948,7 @@ class P12Compiler:
         else:
             f = st_lod
         try:
-            pe.write_lod(f)
+            self.timed("serialize", pe.write_lod, f)
         finally:
             if destfolder is not None:
                 f.close()
@@ -772,7 +1015,7 @@ class P12Compiler:
         else:
             f = st_fix
         try:
-            pe.write_fix(f)
+            self.timed("serialize", pe.write_fix, f)
         finally:
             if destfolder is not None:
                 f.close()
@@ -816,65 +1059,65 @@ class P12Compiler:
     # decompile SCRIPT.DAT
     # =======================================================================
     def pretty_print_scr(self, scrname, stream, enc = None, decsort = False):
-        def pprint(msg):
-            if stream is None:
-                print(msg)
-            else:
-                stream.write((msg + "\n").encode(enc or "UTF-8"))
-
         pe = petka.Engine()
         pe.init_empty("cp1251")
         bkgname = find_in_folder(os.path.dirname(scrname), "backgrnd.bg")
         resname = find_in_folder(os.path.dirname(scrname), "resource.qrc")
         pe.load_script(scrname, bkgname, resname)
-
-        # define lists of used items
-        used_obj = []
-        used_res = []
-
-        def fmtfor(num, objid):
-            if num == objid:
-                return "THIS"
+        write_lines(self.iter_scr(pe, scrname, enc, decsort), stream, enc)
+
+    def iter_scr(self, pe, scrname, enc = None, decsort = False):
+        # generate decompiled lines for loaded script
+        # define sets of used items
+        used_obj = set()
+        used_res = set()
+
+        # cached number formats
+        num16 = FmtCache(self.fmtnum16)
+        num32 = FmtCache(self.fmtnum32)
+        ops = FmtCache(self.fmtop)
+        resops = set([code for code, op in petka.OPCODES.items() \
+            if op[1] == 1])
+
+        def fmtfor(num):
             if num in pe.obj_idx:
                 return "obj_{}".format(num)
             if num in pe.scn_idx:
                 return "scene_{}".format(num)
             return self.fmtnum16(num)
+        refs = FmtCache(fmtfor)
 
-        def printres(resid):
-            pprint("RES res_{} 0x{:x} \"{}\"".format(resid, resid,
-                self.escstr(pe.res[resid])))
-            pprint("")
+        def genres(resid):
+            yield "RES res_{} 0x{:x} \"{}\"".format(resid, resid,
+                self.escstr(pe.res[resid]))
+            yield ""
 
-        def printrescheck(resid, opcode):
-            tp = petka.OPCODES.get(opcode, ("", 0))[1]
-            if tp == 1 and resid in pe.res:
+        def genrescheck(resid, opcode):
+            if opcode in resops and resid in pe.res:
                 if resid in used_res:
                     return
-                used_res.append(resid)
-                printres(resid)
+                used_res.add(resid)
+                yield from genres(resid)
 
-        def printitem(item, itemtype):
-            pprint("{} {}_{} 0x{:x} \"{}\"".format(itemtype.upper(), itemtype,
-                item.idx, item.idx, self.escstr(item.name)))
+        def genitem(item, itemtype):
+            yield "{} {}_{} 0x{:x} \"{}\"".format(itemtype.upper(),
+                itemtype, item.idx, item.idx, self.escstr(item.name))
 
             # sub objects
             if itemtype == "scene":
                 if len(item.refs) == 0:
-                    pprint("  ZEROREF")
+                    yield "  ZEROREF"
                 for obj, a1, a2, a3, a4, a5 in item.refs:
                     if obj.idx in pe.obj_idx:
                         ref = "obj_{}".format(obj.idx)
                     elif obj.idx in pe.scn_idx:
-                        ref = "scene_".format(obj.idx)
+                        ref = "scene_{}".format(obj.idx)
                     else:
-                        pprint("  # unknown reference to 0x{:x}".format(
-                           obj.idx))
+                        yield "  # unknown reference to 0x{:x}".format(
+                           obj.idx)
                         ref = "0x{:x}".format(obj.idx)
-                    pprint("  REF {} {} {} {} {} {}".format(ref,
-                        self.fmtnum32(a1), self.fmtnum32(a2),
-                        self.fmtnum32(a3), self.fmtnum32(a4),
-                        self.fmtnum32(a5)))
+                    yield "  REF {} {} {} {} {} {}".format(ref, num32[a1],
+                        num32[a2], num32[a3], num32[a4], num32[a5])
 
             for act in item.acts:
                 actif = ""
@@ -883,123 +1126,122 @@ class P12Compiler:
                     if act.act_ref == item.idx:
                         actif += "THIS"
                     else:
-                        actif += self.fmtnum16(act.act_ref)
-                pprint("  ON {}{}".format(self.fmtop(act.act_op), actif))
+                        actif += num16[act.act_ref]
+                yield "  ON {}{}".format(ops[act.act_op], actif)
                 # list actions
                 for op in act.ops:
-                    if op.op_arg1 in pe.res and \
-                            petka.OPCODES.get(op.op_code, ["", 0])[1] == 1:
+                    if op.op_code in resops and op.op_arg1 in pe.res:
                         res = "res_{}".format(op.op_arg1)
                     else:
-                        res = self.fmtnum16(op.op_arg1)
-                    pprint("    {} {} {} {} {}".format(self.fmtop(op.op_code),
-                        fmtfor(op.op_ref, item.idx), res,
-                        self.fmtnum16(op.op_arg2),
-                        self.fmtnum16(op.op_arg3)))
-                pprint("  ENDON")
+                        res = num16[op.op_arg1]
+                    if op.op_ref == item.idx:
+                        ref = "THIS"
+                    else:
+                        ref = refs[op.op_ref]
+                    yield "    {} {} {} {} {}".format(ops[op.op_code], ref,
+                        res, num16[op.op_arg2], num16[op.op_arg3])
+                yield "  ENDON"
 
-            pprint("END{} # {}_{}".format(itemtype.upper(), itemtype, item.idx))
-            pprint("")
+            yield "END{} # {}_{}".format(itemtype.upper(), itemtype, item.idx)
+            yield ""
 
-        pprint("# Decompile SCRIPT \"{}\"".format(scrname))
-        pprint("# Version: {}".format(VERSION))
-        pprint("# Encoding: {}".format(enc))
+        yield "# Decompile SCRIPT \"{}\"".format(scrname)
+        yield "# Version: {}".format(VERSION)
+        yield "# Encoding: {}".format(enc)
 
         if decsort:
             for idx, scene in enumerate(pe.scenes):
-                pprint("# Scene {} / {}".format(idx + 1, len(pe.scenes)))
+                yield "# Scene {} / {}".format(idx + 1, len(pe.scenes))
                 # display used objects
-                if len(scene.idx.refs) > 0:
-                    pprint("# referenced objects {}:".format(len(scene.refs)))
+                if len(scene.refs) > 0:
+                    yield "# referenced objects {}:".format(len(scene.refs))
                     for ref in scene.refs:
-                        if ref[0].idx in used_obj:
-                            pprint("# object 0x{:x} already defined".\
-                                format(ref[0].idx))
+                        obj = ref[0]
+                        if obj.idx in used_obj:
+                            yield "# object 0x{:x} already defined".\
+                                format(obj.idx)
                             continue
-                        used_obj.append(ref[0].idx)
-                        if ref[0].idx in pe.obj_idx:
-                            for act in ref[0].acts_array:
-                                for op in act.ops_array:
-                                    printrescheck(op.op_arg1, op.op_code)
-                            printitem(obj, "obj")
+                        used_obj.add(obj.idx)
+                        if obj.idx in pe.obj_idx:
+                            for act in obj.acts:
+                                for op in act.ops:
+                                    yield from genrescheck(op.op_arg1,
+                                        op.op_code)
+                            yield from genitem(obj, "obj")
                 else:
-                    pprint("# No referenced objects")
+                    yield "# No referenced objects"
                 # display res
                 for act in scene.acts:
                     for op in act.ops:
-                        printrescheck(op.op_arg1, op.op_code)
-                printitem(scene, "scene")
+                        yield from genrescheck(op.op_arg1, op.op_code)
+                yield from genitem(scene, "scene")
             # list unused
             msg = False
             for obj in pe.objects:
                 if obj.idx in used_obj: continue
                 if not msg:
-                    pprint("# Note: Following objects not listed anywhere")
+                    yield "# Note: Following objects not listed anywhere"
                     msg = True
-                printitem(obj, "OBJ")
+                yield from genitem(obj, "obj")
             msg = False
-            for res in self.res:
+            for res in pe.resord:
                 if res in used_res: continue
                 if not msg:
-                    pprint("# Note: Following resources not listed anywhere")
+                    yield "# Note: Following resources not listed anywhere"
                     msg = True
-                printres(res)
+                yield from genres(res)
         else:
             for obj in pe.objects:
-                printitem(obj, "obj")
+                yield from genitem(obj, "obj")
             for scene in pe.scenes:
-                printitem(scene, "scene")
+                yield from genitem(scene, "scene")
             for res in pe.resord:
-                printres(res)
+                yield from genres(res)
 
     # =======================================================================
     # decompile DIALOGUE.FIX
     # =======================================================================
     def pretty_print_dlg(self, fixname, stream, enc = None, verbose = False):
-        def pprint(msg):
-            if stream is None:
-                print(msg)
-            else:
-                stream.write((msg + "\n").encode(enc or "UTF-8"))
-
         pe = petka.Engine()
         pe.init_empty("cp1251")
         lodname = find_in_folder(os.path.dirname(fixname), "dialogue.lod")
         pe.load_dialogs(fixname, lodname, True)
+        write_lines(self.iter_dlg(pe, fixname, enc, verbose), stream, enc)
 
-        pprint("# Decompile DIALOGUE \"{}\"".format(fixname))
-        pprint("# Version: {}".format(VERSION))
-        pprint("# Encoding: {}".format(enc))
+    def iter_dlg(self, pe, fixname, enc = None, verbose = False):
+        # generate decompiled lines for loaded dialogs
+        yield "# Decompile DIALOGUE \"{}\"".format(fixname)
+        yield "# Version: {}".format(VERSION)
+        yield "# Encoding: {}".format(enc)
 
         for msg in pe.msgs:
-            pprint("# {} = 0x{:x}".format(msg.idx, msg.idx))
-            pprint("MSG msg_{} \"{}\" 0x{:x} 0x{:x} 0x{:x}".format(\
-                msg.idx, msg.msg_wav, msg.msg_arg1, msg.msg_arg2, msg.msg_arg3))
-            pprint(" \"{}\"".format(self.escstr(msg.name)))
-            pprint("")
+            yield "# {} = 0x{:x}".format(msg.idx, msg.idx)
+            yield "MSG msg_{} \"{}\" 0x{:x} 0x{:x} 0x{:x}".format(\
+                msg.idx, msg.msg_wav, msg.msg_arg1, msg.msg_arg2, msg.msg_arg3)
+            yield " \"{}\"".format(self.escstr(msg.name))
+            yield ""
 
         for gidx, grp in enumerate(pe.dlgs, 1):
-            pprint("# {} = 0x{:x}".format(gidx, gidx))
-            pprint("DLGGRP 0x{:x} {}".format(grp.idx, \
-                self.fmtnum32(grp.grp_arg1)))
+            yield "# {} = 0x{:x}".format(gidx, gidx)
+            yield "DLGGRP 0x{:x} {}".format(grp.idx, \
+                self.fmtnum32(grp.grp_arg1))
             for sidx, act in enumerate(grp.acts, 1):
-                pprint("  ON {} 0x{:x} 0x{:x} 0x{:x} # {}".format(\
+                yield "  ON {} 0x{:x} 0x{:x} 0x{:x} # {}".format(\
                     self.fmtop(act.opcode), act.ref, act.arg1,
-                        act.arg2, sidx))
+                        act.arg2, sidx)
                 # print code
                 for didx, dlg in enumerate(act.dlgs, 1):
                     #print(bsrec)
-                    pprint("    DLG 0x{:x} 0x{:x} # {}".format(\
-                        dlg.arg1, dlg.arg2, didx))
+                    yield "    DLG 0x{:x} 0x{:x} # {}".format(\
+                        dlg.arg1, dlg.arg2, didx)
                     # scan used addr
-                    usedadr = []
+                    usedadr = set()
                     for op in dlg.ops:
                         if op.opcode == 0x3 or \
                             op.opcode == 0x4: # GOTO or MENURET
-                            if op.ref not in usedadr:
-                                usedadr.append(op.ref)
+                            usedadr.add(op.ref)
                     if len(usedadr) > 0:
-                        usedadr.append(dlg.op_start)
+                        usedadr.add(dlg.op_start)
                     usedmenu = {}
                     usedcase = {}
                     for oidx, op in enumerate(dlg.ops):
@@ -1007,8 +1249,8 @@ class P12Compiler:
                         opref = "0x{:X}".format(op.ref)
                         opcode = self.fmtdlgop(op.opcode)
                         if op.pos in usedadr:
-                             pprint("      label_{:X}:".format(
-                                op.pos))
+                             yield "      label_{:X}:".format(
+                                op.pos)
                         if op.opcode == 0x1: # BREAK
                             if op.pos in usedcase:
                                 if len(usedadr) > 0:
@@ -1070,13 +1312,13 @@ class P12Compiler:
                             oparg = ""
                             opref = ""
                         if cmt and verbose:
-                            pprint("        " + cmt)
-                        pprint("        {}{}{}".\
-                            format(opcode, oparg, opref))
-                    pprint("    ENDDLG # {}".format(didx))
-                pprint("  ENDON # {}".format(sidx))
-            pprint("ENDDLGGRP # {}".format(gidx))
-            pprint("")
+                            yield "        " + cmt
+                        yield "        {}{}{}".\
+                            format(opcode, oparg, opref)
+                    yield "    ENDDLG # {}".format(didx)
+                yield "  ENDON # {}".format(sidx)
+            yield "ENDDLGGRP # {}".format(gidx)
+            yield ""
 
 
 # check if file already exists and flag for overwrite not set
@@ -1133,27 +1375,53 @@ def action_comp(args):
     print("Enc:\t{}".format(args.encoding or "UTF-8"))
 
     dcs = P12Compiler()
-    if os.path.exists(args.destfolder) and not args.fo:
+    # incremental compile updates own output
+    if os.path.exists(args.destfolder) and not args.fo and \
+            not args.incremental:
         cnt = 0
         lst = ["script.dat", "backgrnd.bg", "resource.qrc"]
         for item in lst:
             if find_in_folder(args.destfolder, item, False):
                 print("Error: destination file \"{}\" already "\
                     "exists, use -fo to overwrite".format(item))
-                return
+                return -1
 
     if not os.path.exists(args.destfolder):
         os.makedirs(args.destfolder)
+    cache = None
+    if args.incremental:
+        cachepath = os.path.join(args.destfolder, INC_CACHE)
+        cache = load_inc_cache(cachepath)
     f = open(args.sourcepath, "rb")
     try:
-        dcs.compile_script(f, args.destfolder, args.encoding)
+        dcs.compile_script(f, args.destfolder, args.encoding, cache = cache)
+        if cache is not None:
+            save_inc_cache(cachepath, cache)
     except ScriptSyntaxError as e:
         if args.trace_error:
             traceback.print_exc()
         print(e, file = sys.stderr)
+        return -3
     finally:
         f.close()
 
+def load_inc_cache(path):
+    # blocks cache of incremental compile, empty if missing or outdated
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") == INC_VERSION:
+            return data["blocks"]
+    except Exception as e:
+        if os.path.exists(path):
+            print("DEBUG: Bad incremental cache: " + str(e))
+    return {}
+
+def save_inc_cache(path, cache):
+    with open(path, "wb") as f:
+        pickle.dump({"version": INC_VERSION, "blocks": cache}, f,
+            pickle.HIGHEST_PROTOCOL)
+
 def action_decd(args):
     print("Decompile DIALOGUE.FIX file")
     destpath = args.destpath
@@ -1199,7 +1467,7 @@ def action_compd(args):
             if find_in_folder(args.destfolder, item, False):
                 print("Error: destination file \"{}\" already "\
                     "exists, use -fo to overwrite".format(item))
-                return
+                return -1
 
     if not os.path.exists(args.destfolder):
         os.makedirs(args.destfolder)
@@ -1210,77 +1478,770 @@ def action_compd(args):
         if args.trace_error:
             traceback.print_exc()
         print(e, file = sys.stderr)
+        return -3
     finally:
         f.close()
 
-def internaltest(folder):
-    test_arr = [
-      "p1demo",
-      "p1-0", "p1-1", "p1-2", "p1-3",
-      "p2-0", "p2-1", "p2-2"
-    ]
+def action_extract(args):
+    print("Extract STR file")
+    print("Input:\t{}".format(args.sourcepath))
+    print("Output:\t{}".format(args.destfolder))
+
+    if os.path.exists(args.destfolder) and os.listdir(args.destfolder) and \
+            not args.fo:
+        print("Error: destination folder \"{}\" not empty, use -fo to "\
+            "overwrite".format(args.destfolder))
+        return -1
+
+    fm = petka.FileManager(os.path.dirname(os.path.abspath(args.sourcepath)))
+    fm.load_store(os.path.basename(args.sourcepath))
+    if len(fm.strfd) == 0:
+        print("Error: can't open store \"{}\"".format(args.sourcepath))
+        return -2
+    try:
+        tm = time.time()
+        cnt, total = fm.extract_store(0, args.destfolder, args.workers)
+        tm = time.time() - tm
+    finally:
+        fm.unload_stores()
+    print("Extracted: {} files, {} bytes in {:.2f} sec ({:.1f} MB/s)".format(
+        cnt, total, tm, total / max(tm, 1e-6) / (1 << 20)))
+
+def action_pack(args):
+    print("Pack STR file")
+    print("Input:\t{}".format(args.sourcefolder))
+    print("Output:\t{}".format(args.destpath))
+    if args.base:
+        print("Base:\t{}".format(args.base))
+
+    if os.path.exists(args.destpath) and not args.fo:
+        print("Error: destination file \"{}\" already exists, use -fo to "\
+            "overwrite".format(args.destpath))
+        return -1
+    # files from folder, relative names
+    src = {}
+    files = []
+    for root, dirs, fns in os.walk(args.sourcefolder):
+        dirs.sort()
+        for fn in sorted(fns):
+            path = os.path.join(root, fn)
+            rel = os.path.relpath(path, args.sourcefolder)
+            rel = rel.replace(os.sep, "/")
+            src[rel.lower()] = path
+            files.append((rel, path))
+    bfm = None
+    if args.base:
+        bfm = petka.FileManager(os.path.dirname(os.path.abspath(args.base)))
+        bfm.load_store(os.path.basename(args.base))
+        if len(bfm.strfd) == 0:
+            print("Error: can't open store \"{}\"".format(args.base))
+            return -2
+    try:
+        tm = time.time()
+        # folder files override base store records
+        with petka.StoreWriter(args.destpath) as sw:
+            for rel, path in files:
+                sw.add_file(rel, path)
+            if bfm:
+                sw.add_store(bfm, 0)
+            total = sw.pos
+        tm = time.time() - tm
+        print("Packed: {} files, {} bytes in {:.2f} sec ({:.1f} MB/s)".format(
+            len(sw.records), total, tm, total / max(tm, 1e-6) / (1 << 20)))
+        # verify: read back packed store
+        fm = petka.FileManager(os.path.dirname(os.path.abspath(
+            args.destpath)))
+        fm.load_store(os.path.basename(args.destpath))
+        err = 0
+        if len(fm.strtableord) != len(sw.records):
+            print("Error: {} records in index, expected {}".format(
+                len(fm.strtableord), len(sw.records)))
+            err += 1
+        for fname in fm.strtableord:
+            data = fm.read_file(fname, True)
+            if fname in src:
+                with open(src[fname], "rb") as f:
+                    ok = f.read() == data
+            else:
+                ok = bfm.read_file(fname, True) == data
+            if not ok:
+                print("Error: record \"{}\" mismatch".format(fname))
+                err += 1
+        fm.unload_stores()
+        if err:
+            return -3
+        print("Verify: OK")
+    finally:
+        if bfm:
+            bfm.unload_stores()
+
+def action_preload(args):
+    print("Preload parts")
+    print("Input:\t{}".format(args.sourcefolder))
+
+    sim = petka.Engine()
+    sim.columnar = args.columnar
+    sim.load_data(args.sourcefolder, args.encoding or "cp1251")
+    try:
+        parts = sim.part_ids()
+        if len(parts) == 0:
+            print("Error: no parts in \"{}\"".format(args.sourcefolder))
+            return -1
+        tm = time.time()
+        serial = sim.preload_parts(parts, 0)
+        tms = time.time() - tm
+        tm = time.time()
+        models = sim.preload_parts(parts, args.workers)
+        tmp = time.time() - tm
+    finally:
+        sim.fman.unload_stores()
+    err = 0
+    for key in parts:
+        model = models[key]
+        data = pickle.dumps(model, pickle.HIGHEST_PROTOCOL)
+        # compare by attribute, shared objects differ between processes
+        diff = [attr for attr in model if pickle.dumps(model[attr]) != \
+            pickle.dumps(serial[key][attr])]
+        if diff:
+            print("Error: part {} chapter {} differs from serial load: {}".\
+                format(key[0], key[1], ", ".join(diff)))
+            err += 1
+        print("Part {} chapter {}: {} objects, {} scenes, {} messages, "\
+            "{} bytes".format(key[0], key[1], len(model["objects"]), \
+            len(model["scenes"]), len(model["msgs"]), len(data)))
+    print("Serial:   {:.2f} sec".format(tms))
+    print("Parallel: {:.2f} sec ({:.1f}x)".format(tmp, tms / max(tmp, 1e-6)))
+    if err:
+        return -2
+
+# batch jobs: action -> (function, outputs in destination)
+BATCH_ACTIONS = {
+    "decompile": (action_dec, None),
+    "compile": (action_comp, ["script.dat", "backgrnd.bg", "resource.qrc"]),
+    "decompiledialog": (action_decd, None),
+    "compiledialog": (action_compd, ["dialogue.fix", "dialogue.lod"]),
+}
+# extra inputs read from source folder
+BATCH_INPUTS = {
+    "decompile": ["backgrnd.bg", "resource.qrc"],
+    "decompiledialog": ["dialogue.lod"],
+}
+BATCH_ALIASES = {"d": "decompile", "c": "compile", "dd": "decompiledialog",
+    "cd": "compiledialog"}
+
+def batch_outputs(action, dest):
+    outs = BATCH_ACTIONS[action][1]
+    if outs is None:
+        return [dest]
+    return [os.path.join(dest, fn) for fn in outs]
+
+def batch_stamp(action, src, dest, encoding = None, incremental = False):
+    # inputs identity and options, None if source missing
+    inputs = []
+    for fn in [src] + [find_in_folder(os.path.dirname(src), name) for name \
+            in BATCH_INPUTS.get(action, [])]:
+        try:
+            st = os.stat(fn)
+            inputs.append((os.path.abspath(fn), st.st_mtime_ns, st.st_size))
+        except OSError:
+            if fn == src:
+                return None
+            inputs.append((os.path.abspath(fn), None, None))
+    return (VERSION, action, os.path.abspath(dest), encoding,
+        incremental and action == "compile", tuple(inputs))
+
+def batch_manifest(path):
+    # lines: <action> <source> <destination>, paths relative to manifest
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    f = open(path, "rb")
+    try:
+        for lineno, tokens in P12Compiler().tokenizer(f, None):
+            if len(tokens) == 0:
+                continue
+            action = BATCH_ALIASES.get(tokens[0].lower(), tokens[0].lower())
+            if action not in BATCH_ACTIONS or len(tokens) != 3:
+                raise ScriptSyntaxError("Error at {}: bad batch job "\
+                    "\"{}\"".format(lineno, " ".join(tokens)))
+            jobs.append((action, os.path.join(base, tokens[1]),
+                os.path.join(base, tokens[2])))
+    finally:
+        f.close()
+    return jobs
+
+def batch_folder(folder, destfolder, comp):
+    # decompile each part folder or compile decompiled sources back
+    if comp:
+        names = [("script.txt", "compile"), ("dialogue.txt",
+            "compiledialog")]
+    else:
+        names = [("script.dat", "decompile"), ("dialogue.fix",
+            "decompiledialog")]
+    jobs = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        dest = os.path.join(destfolder, os.path.relpath(root, folder))
+        for name, action in names:
+            path = find_in_folder(root, name, False)
+            if path is None:
+                continue
+            if comp:
+                jobs.append((action, path, dest))
+            else:
+                jobs.append((action, path, os.path.join(dest,
+                    "script.txt" if action == "decompile" else
+                    "dialogue.txt")))
+    return jobs
+
+def run_batch_job(job, encoding = None, incremental = False):
+    # worker: run action with captured output -> (status, output, time)
+    action, src, dest = job
+    args = argparse.Namespace(sourcepath = src, destpath = dest,
+        destfolder = dest, encoding = encoding, fo = True,
+        decompile_sorted = False, verbose = False, trace_error = False,
+        incremental = incremental)
+    out = io.StringIO()
+    tm = time.time()
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+            if BATCH_ACTIONS[action][1] is None:
+                os.makedirs(os.path.dirname(os.path.abspath(dest)),
+                    exist_ok = True)
+            ret = BATCH_ACTIONS[action][0](args)
+    except Exception:
+        out.write(traceback.format_exc())
+        ret = -4
+    return ret or 0, out.getvalue(), time.time() - tm
+
+def action_batch(args):
+    print("Batch compile/decompile")
+    print("Input:\t{}".format(args.source))
+    if os.path.isdir(args.source):
+        if not args.destfolder:
+            print("Error: output folder required for folder input, use -o")
+            return -1
+        jobs = batch_folder(args.source, args.destfolder, args.compile)
+        statepath = os.path.join(args.destfolder, "batch.state")
+    else:
+        try:
+            jobs = batch_manifest(args.source)
+        except ScriptSyntaxError as e:
+            print(e, file = sys.stderr)
+            return -1
+        statepath = args.source + ".state"
+    # job -> source stamp of last successful run
+    state = {}
+    try:
+        with open(statepath, "rb") as f:
+            state = pickle.load(f)
+    except Exception:
+        pass
+
+    run = []
+    skipped = 0
+    for job in jobs:
+        stamp = batch_stamp(job[0], job[1], job[2], args.encoding,
+            args.incremental)
+        if not args.fo and stamp is not None and state.get(job) == stamp \
+                and all([os.path.exists(fn) for fn in batch_outputs(
+                    job[0], job[2])]):
+            print("[skip] {} {} -> {}".format(*job))
+            skipped += 1
+            continue
+        run.append((job, stamp))
+
+    failed = 0
+    total = 0
+    tm = time.time()
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as ex:
+        futs = [(job, stamp, ex.submit(run_batch_job, job, args.encoding,
+            args.incremental)) for job, stamp in run]
+        for job, stamp, fut in futs:
+            ret, out, jtm = fut.result()
+            total += jtm
+            if ret:
+                failed += 1
+                state.pop(job, None)
+                print("[fail] {:.2f} sec {} {} -> {}".format(jtm, *job))
+                print(out.rstrip())
+            else:
+                state[job] = stamp
+                print("[ok] {:.2f} sec {} {} -> {}".format(jtm, *job))
+    tm = time.time() - tm
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(statepath)),
+            exist_ok = True)
+        with open(statepath, "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print("DEBUG: Can't save batch state: " + str(e))
+    print("Jobs: {}, done {}, skipped {}, failed {}".format(len(jobs),
+        len(run) - failed, skipped, failed))
+    print("Time: {:.2f} sec, jobs total {:.2f} sec".format(tm, total))
+    if failed:
+        return -1
+
+def check_tokenizer(data, enc = None):
+    # tokenizer output same as char by char reference
+    dcs = P12Compiler()
+    return list(dcs.tokenizer(io.BytesIO(data), enc)) == \
+        list(dcs.tokenizer_ref(io.BytesIO(data), enc))
+
+# round-trip test parts, all folders with SCRIPT.DAT if none found
+TEST_PARTS = [
+    "p1demo",
+    "p1-0", "p1-1", "p1-2", "p1-3",
+    "p2-0", "p2-1", "p2-2"
+]
+TEST_STAGES = ["decompile", "tokenize", "compile", "serialize"]
+
+def first_diff(data1, data2):
+    # offset of first differing byte, None if same
+    ln = min(len(data1), len(data2))
+    step = 4096
+    for off in range(0, ln, step):
+        if data1[off:off + step] != data2[off:off + step]:
+            for i in range(off, min(off + step, ln)):
+                if data1[i] != data2[i]:
+                    return i
+    if len(data1) != len(data2):
+        return ln
+    return None
+
+def roundtrip_part(testbase, digests):
+    # worker: decompile -> compile one part, compare with reference digests
+    # -> (mismatches, timings, errors)
+    mismatches = []
+    errors = []
+    dcs = P12Compiler()
+    dcs.timings = dict([(stage, 0) for stage in TEST_STAGES])
+
     def compare(fn, mem):
+        data = mem.getvalue()
+        if hashlib.md5(data).hexdigest() == digests.get(fn):
+            return
         f = open(fn, "rb")
-        hf = hashlib.md5()
         try:
-            hf.update(f.read())
+            mismatches.append((os.path.basename(fn), first_diff(f.read(),
+                data)))
         finally:
             f.close()
-        mem.seek(0)
-        hm = hashlib.md5()
-        hm.update(mem.read())
-        return hm.hexdigest() == hf.hexdigest()
-
-    for test in test_arr:
-        print("=== Test: " + test + " ===")
-        testbase = os.path.join(folder, test)
-        path = find_in_folder(testbase, "script.dat")
-        dcs = P12Compiler()
+
+    def roundtrip(decompile, compile, names):
+        # names - source files, compiled outputs in the same order
         mems = io.BytesIO()
-        dcs.pretty_print_scr(path, mems)
-        print("Decompiled script:", mems.tell())
-        # compile back
-        memscr = io.BytesIO()
-        membkg = io.BytesIO()
-        memres = io.BytesIO()
+        tm = time.perf_counter()
+        decompile(names[0], mems)
+        dcs.timings["decompile"] += time.perf_counter() - tm
+        if not check_tokenizer(mems.getvalue()):
+            mismatches.append(("tokenizer", None))
+        outs = [io.BytesIO() for fn in names]
         mems.seek(0)
-        ndcs = P12Compiler()
-        ndcs.compile_script(mems, None, None, \
-            memscr, membkg, memres)
-        # compare
-        if not compare(path, memscr):
-            print("SCRIPT.DAT - mismatch")
-            break
-        if not compare(find_in_folder(testbase, "backgrnd.bg"), membkg):
-            print("BACKGRND.BG - mismatch")
-            break
-
-        # dialogue
-        dcs = P12Compiler()
-        path = find_in_folder(testbase, "dialogue.fix")
-        if not os.path.exists(path):
-            print("All ok - no dialogue")
+        tok, ser = dcs.timings["tokenize"], dcs.timings["serialize"]
+        tm = time.perf_counter()
+        compile(mems, None, None, *outs)
+        dcs.timings["compile"] += time.perf_counter() - tm - \
+            (dcs.timings["tokenize"] - tok) - (dcs.timings["serialize"] - ser)
+        for fn, mem in zip(names, outs):
+            if fn:
+                compare(fn, mem)
+
+    out = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            path = find_in_folder(testbase, "script.dat")
+            roundtrip(dcs.pretty_print_scr, dcs.compile_script, [path,
+                find_in_folder(testbase, "backgrnd.bg"), None])
+            path = find_in_folder(testbase, "dialogue.fix", False)
+            if path:
+                roundtrip(dcs.pretty_print_dlg, dcs.compile_dialog, [path,
+                    find_in_folder(testbase, "dialogue.lod")])
+    except Exception:
+        errors.append(traceback.format_exc())
+    return mismatches, dcs.timings, errors
+
+def reference_digests(folder, bases):
+    # md5 of original files, cached by path, size and mtime
+    cachepath = os.path.join(folder, "roundtrip.md5")
+    cache = {}
+    try:
+        with open(cachepath, "rb") as f:
+            cache = pickle.load(f)
+    except Exception:
+        pass
+    digests = {}
+    ncache = {}
+    for base in bases:
+        for name in ["script.dat", "backgrnd.bg", "dialogue.fix",
+                "dialogue.lod"]:
+            fn = find_in_folder(base, name, False)
+            if fn is None:
+                continue
+            st = os.stat(fn)
+            key = (fn, st.st_mtime_ns, st.st_size)
+            if key not in cache:
+                f = open(fn, "rb")
+                try:
+                    cache[key] = hashlib.md5(f.read()).hexdigest()
+                finally:
+                    f.close()
+            ncache[key] = digests[fn] = cache[key]
+    try:
+        with open(cachepath, "wb") as f:
+            pickle.dump(ncache, f, pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print("DEBUG: Can't save digests cache: " + str(e))
+    return digests
+
+def internaltest(folder, workers = None):
+    tests = [test for test in TEST_PARTS if os.path.isdir(os.path.join(
+        folder, test))]
+    if not tests:
+        tests = [os.path.relpath(os.path.dirname(path), folder) for path in
+            bench_files(folder, "script.dat")]
+    bases = [os.path.join(folder, test) for test in tests]
+    digests = reference_digests(folder, bases)
+
+    failed = 0
+    totals = dict([(stage, 0) for stage in TEST_STAGES])
+    tm = time.time()
+    with concurrent.futures.ProcessPoolExecutor(workers) as ex:
+        futs = [ex.submit(roundtrip_part, base, digests) for base in bases]
+        for test, fut in zip(tests, futs):
+            mismatches, timings, errors = fut.result()
+            print("=== Test: " + test + " ===")
+            print("  " + ", ".join(["{} {:.2f} ms".format(stage,
+                timings[stage] * 1000) for stage in TEST_STAGES]))
+            for stage in TEST_STAGES:
+                totals[stage] += timings[stage]
+            for fn, off in mismatches:
+                if off is None:
+                    print("{} - mismatch".format(fn.upper()))
+                else:
+                    print("{} - mismatch at offset 0x{:x}".format(fn.upper(),
+                        off))
+            for err in errors:
+                print(err.rstrip())
+            if mismatches or errors:
+                failed += 1
+            else:
+                print("All ok")
+    print("=== Total: {} parts, {} failed, {:.2f} sec ===".format(len(tests),
+        failed, time.time() - tm))
+    print("  " + ", ".join(["{} {:.2f} ms".format(stage,
+        totals[stage] * 1000) for stage in TEST_STAGES]))
+    if failed:
+        return -1
+
+def legacy_parse_script(enc, data):
+    # SCRIPT.DAT parser before memoryview version, for bench only
+    objects = []
+    scenes = []
+    num_obj, num_scn = struct.unpack_from("<II", data[:8])
+    off = 8
+    def read_rec(off):
+        obj_id, name_len = struct.unpack_from("<HI", data[off:off + 6])
+        off += 6
+        name = data[off:off + name_len].decode(enc)
+        off += name_len
+        num_act = struct.unpack_from("<I", data[off:off + 4])[0]
+        off += 4
+        acts = []
+        for i in range(num_act):
+            act_op, act_status, act_ref, num_op = struct.unpack_from(\
+                "<HBHI", data[off:off + 9])
+            off += 9
+            act = petka.engine.ScrActObject(act_op, act_status, act_ref)
+            act.ops = []
+            for j in range(num_op):
+                op = struct.unpack_from("<5H", data[off:off + 10])
+                off += 10
+                op = petka.engine.ScrOpObject(*op)
+                act.ops.append(op)
+            acts.append(act)
+        rec = petka.engine.ScrObject(obj_id, name)
+        rec.acts = acts
+        return off, rec
+
+    for i in range(num_obj):
+        off, obj = read_rec(off)
+        objects.append(obj)
+    for i in range(num_scn):
+        off, scn = read_rec(off)
+        scenes.append(scn)
+    return objects, scenes
+
+def legacy_parse_res(enc, f):
+    # RESOURCE.QRC parser before single decode version, for bench only
+    res = {}
+    resord = []
+    for line in f.readlines():
+        line = line.decode(enc).strip()
+        if len(line) == 0:
             continue
+        pair = line.split("=", 1)
+        if len(pair) < 2:
+            continue
+        value = pair[1].strip()
+        if value[:1] == "=":
+            value = value[1:].strip()
+        res_id = int(pair[0].strip(), 10)
+        res[res_id] = value
+        resord.append(res_id)
+    return res, resord
+
+def legacy_write_script(pe, f):
+    # SCRIPT.DAT writer before single buffer version, for bench only
+    f.write(struct.pack("<II", len(pe.objects), len(pe.scenes)))
+    for rec in pe.objects + pe.scenes:
+        ename = rec.name.encode(pe.enc)
+        f.write(struct.pack("<HI", rec.idx, len(ename)))
+        f.write(ename)
+        f.write(struct.pack("<I", len(rec.acts)))
+        for act in rec.acts:
+            f.write(struct.pack("<HBHI", act.act_op, act.act_status,
+                act.act_ref, len(act.ops)))
+            for op in act.ops:
+                f.write(struct.pack("<5H", op.op_ref, op.op_code,
+                    op.op_arg1, op.op_arg2, op.op_arg3))
+
+def bench_time(func, repeat = 5):
+    # best time of repeat runs, seconds
+    best = None
+    for i in range(repeat):
+        tm = time.perf_counter()
+        func()
+        tm = time.perf_counter() - tm
+        if best is None or tm < best:
+            best = tm
+    return best
+
+def bench_files(folder, name):
+    # all files with name in folder tree
+    res = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for fn in sorted(files):
+            if fn.lower() == name:
+                res.append(os.path.join(root, fn))
+    return res
+
+def bench_script(folder):
+    print("=== SCRIPT.DAT parser ===")
+    def dump(recs):
+        return [(rec.idx, rec.name, [(act.act_op, act.act_status,
+            act.act_ref, [(op.op_ref, op.op_code, op.op_arg1, op.op_arg2,
+            op.op_arg3) for op in act.ops]) for act in rec.acts])
+            for rec in recs]
+
+    for path in bench_files(folder, "script.dat"):
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        eng = petka.Engine()
+        eng.init_empty("cp1251")
+        tm_old = bench_time(lambda: legacy_parse_script(eng.enc, data))
+        tm_new = bench_time(lambda: eng.parse_script(data))
+        objects, scenes = legacy_parse_script(eng.enc, data)
+        ok = dump(objects) == dump(eng.objects) and \
+            dump(scenes) == dump(eng.scenes)
+        ops = sum([len(act.ops) for rec in objects + scenes
+            for act in rec.acts])
+        print("{}: {} records, {} ops, legacy {:.2f} ms, new {:.2f} ms, "\
+            "x{:.2f}{}".format(path, len(objects) + len(scenes), ops,
+            tm_old * 1000, tm_new * 1000, tm_old / max(tm_new, 1e-9),
+            "" if ok else " - MISMATCH"))
+
+def bench_res(folder):
+    print("=== RESOURCE.QRC parse, readlines vs single decode ===")
+    for path in bench_files(folder, "resource.qrc"):
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        eng = petka.Engine()
+        eng.init_empty("cp1251")
+        # legacy got BytesIO copy from read_file_stream
+        tm_old = bench_time(lambda: legacy_parse_res(eng.enc,
+            io.BytesIO(data)))
+        tm_new = bench_time(lambda: eng.parse_res(petka.MemStream(data)))
+        res, resord = legacy_parse_res(eng.enc, io.BytesIO(data))
+        new, neword = eng.parse_res(petka.MemStream(data))
+        ok = res == new and resord == neword
+        print("{}: {} records, legacy {:.2f} ms, new {:.2f} ms, "\
+            "x{:.2f}{}".format(path, len(new), tm_old * 1000,
+            tm_new * 1000, tm_old / max(tm_new, 1e-9),
+            "" if ok else " - MISMATCH"))
+
+def bench_compile(folder):
+    print("=== Compile throughput ===")
+    def readfile(path):
+        f = open(path, "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
 
+    for path in bench_files(folder, "script.dat"):
+        base = os.path.dirname(path)
+        srcs = [readfile(path), readfile(find_in_folder(base,
+            "backgrnd.bg"))]
         mems = io.BytesIO()
-        dcs.pretty_print_dlg(path, mems)
-        print("Decompiled dialogue:", mems.tell())
-        # compile back
-        memfix = io.BytesIO()
-        memlod = io.BytesIO()
-        mems.seek(0)
-        ndcs = P12Compiler()
-        ndcs.compile_dialog(mems, None, None, \
-            memfix, memlod)
-        # compare
-        if not compare(path, memfix):
-            print("DIALOGUE.FIX - mismatch")
-            break
-        if not compare(find_in_folder(testbase, "dialogue.lod"), memlod):
-            print("DIALOGUE.LOD - mismatch")
-            break
-
-        print("All ok")
+        P12Compiler().pretty_print_scr(path, mems)
+        def comp_scr():
+            mems.seek(0)
+            outs = [io.BytesIO(), io.BytesIO(), io.BytesIO()]
+            P12Compiler().compile_script(mems, None, None, *outs)
+            return outs
+        fix = find_in_folder(base, "dialogue.fix")
+        memd = None
+        if os.path.exists(fix):
+            srcs += [readfile(fix), readfile(find_in_folder(base,
+                "dialogue.lod"))]
+            memd = io.BytesIO()
+            P12Compiler().pretty_print_dlg(fix, memd)
+        def comp_dlg():
+            if memd is None: return []
+            memd.seek(0)
+            outs = [io.BytesIO(), io.BytesIO()]
+            P12Compiler().compile_dialog(memd, None, None, *outs)
+            return outs
+        cache = {}
+        def comp_inc():
+            mems.seek(0)
+            outs = [io.BytesIO(), io.BytesIO(), io.BytesIO()]
+            P12Compiler().compile_script(mems, None, None, *outs,
+                cache = cache)
+            return outs
+        tm_scr = bench_time(comp_scr, 3)
+        tm_dlg = bench_time(comp_dlg, 3)
+        comp_inc()
+        tm_inc = bench_time(comp_inc, 3)
+        outs = comp_scr()[:2] + comp_dlg()
+        ok = [out.getvalue() for out in outs] == srcs and \
+            [out.getvalue() for out in comp_inc()[:2]] == srcs[:2]
+        total = sum([len(data) for data in srcs])
+        # writers only
+        eng = petka.Engine()
+        eng.init_empty("cp1251")
+        eng.load_script(path, find_in_folder(base, "backgrnd.bg"), "")
+        tm_old = bench_time(lambda: legacy_write_script(eng, io.BytesIO()))
+        tm_new = bench_time(lambda: eng.write_script(io.BytesIO()))
+        print("{}: {} bytes, script {:.2f} ms (incremental {:.2f} ms), "\
+            "dialogs {:.2f} ms, {:.1f} MB/s; write_script legacy {:.2f} ms, "\
+            "new {:.2f} ms, x{:.2f}{}".format(base, total, tm_scr * 1000,
+            tm_inc * 1000, tm_dlg * 1000,
+            total / max(tm_scr + tm_dlg, 1e-9) / (1 << 20), tm_old * 1000,
+            tm_new * 1000, tm_old / max(tm_new, 1e-9),
+            "" if ok else " - MISMATCH"))
+
+def bench_tokenizer(folder):
+    print("=== Tokenizer, char by char vs regex ===")
+    samples = [
+        'OBJ 0x0001 "name with spaces" # comment',
+        '"esc \\" quote" "back\\\\slash" ""',
+        'pre"fix string"tail "unterminated \\',
+        'tabs\tand  spaces#comment "not string"',
+    ]
+    ok = check_tokenizer("\n".join(samples).encode("UTF-8"))
+    print("Samples: {}".format("ok" if ok else "MISMATCH"))
+    dcs = P12Compiler()
+    for path in bench_files(folder, "script.dat"):
+        srcs = [io.BytesIO()]
+        dcs.pretty_print_scr(path, srcs[0])
+        fix = find_in_folder(os.path.dirname(path), "dialogue.fix")
+        if os.path.exists(fix):
+            srcs.append(io.BytesIO())
+            dcs.pretty_print_dlg(fix, srcs[1])
+        data = b"".join([src.getvalue() for src in srcs])
+        lines = data.count(b"\n")
+        tm_old = bench_time(lambda: list(dcs.tokenizer_ref(io.BytesIO(data),
+            None)), 3)
+        tm_new = bench_time(lambda: list(dcs.tokenizer(io.BytesIO(data),
+            None)), 3)
+        print("{}: {} lines, char {:.0f} lines/s, regex {:.0f} lines/s, "\
+            "x{:.2f}{}".format(os.path.dirname(path), lines,
+            lines / max(tm_old, 1e-9), lines / max(tm_new, 1e-9),
+            tm_old / max(tm_new, 1e-9),
+            "" if check_tokenizer(data) else " - MISMATCH"))
+
+def bench_decompile(folder):
+    print("=== Decompile, generate vs generate and encode ===")
+    dcs = P12Compiler()
+    for path in bench_files(folder, "script.dat"):
+        pe = petka.Engine()
+        pe.init_empty("cp1251")
+        pe.load_script(path, find_in_folder(os.path.dirname(path),
+            "backgrnd.bg"), find_in_folder(os.path.dirname(path),
+            "resource.qrc"))
+        lines = len(list(dcs.iter_scr(pe, path)))
+        tm_gen = bench_time(lambda: collections.deque(dcs.iter_scr(pe,
+            path), 0), 3)
+        tm_all = bench_time(lambda: write_lines(dcs.iter_scr(pe, path),
+            io.BytesIO(), "cp1251"), 3)
+        print("{}: {} lines, generate {:.2f} ms, with encode {:.2f} ms, "\
+            "{:.0f} lines/s".format(os.path.dirname(path), lines,
+            tm_gen * 1000, tm_all * 1000, lines / max(tm_all, 1e-9)))
+
+def bench_memory(folder):
+    print("=== Memory per part, dict vs __slots__ model classes ===")
+    names = ["ScrObject", "ScrActObject", "ScrOpObject", "MsgObject",
+        "DlgGrpObject", "DlgActObject", "DlgObject", "DlgOpObject"]
+    slotted = dict([(name, getattr(petka.engine, name)) for name in names])
+    # same constructors, instances with __dict__
+    plain = dict([(name, type(name, (), {"__init__": cls.__init__}))
+        for name, cls in slotted.items()])
+
+    def load(path):
+        eng = petka.Engine()
+        eng.init_empty("cp1251")
+        eng.load_script(path, find_in_folder(os.path.dirname(path),
+            "backgrnd.bg"), find_in_folder(os.path.dirname(path),
+            "resource.qrc"))
+        eng.load_dialogs(find_in_folder(os.path.dirname(path),
+            "dialogue.fix"), find_in_folder(os.path.dirname(path),
+            "dialogue.lod"))
+        return eng
+
+    def measure(path, classes):
+        for name, cls in classes.items():
+            setattr(petka.engine, name, cls)
+        try:
+            gc.collect()
+            tracemalloc.start()
+            try:
+                base = tracemalloc.get_traced_memory()[0]
+                eng = load(path)
+                mem = tracemalloc.get_traced_memory()[0] - base
+            finally:
+                tracemalloc.stop()
+        finally:
+            for name, cls in slotted.items():
+                setattr(petka.engine, name, cls)
+        return mem
+
+    total_old = total_new = 0
+    for path in bench_files(folder, "script.dat"):
+        mem_old = measure(path, plain)
+        mem_new = measure(path, slotted)
+        total_old += mem_old
+        total_new += mem_new
+        print("{}: dict {} bytes, slots {} bytes, -{:.1f}%".format(
+            os.path.dirname(path), mem_old, mem_new,
+            100 - mem_new * 100 / max(mem_old, 1)))
+    print("Total: dict {} bytes, slots {} bytes".format(total_old, total_new))
+
+def bench(folder):
+    bench_script(folder)
+    bench_res(folder)
+    bench_tokenizer(folder)
+    bench_decompile(folder)
+    bench_compile(folder)
+    bench_memory(folder)
 
 def action_version(args):
     print("Version: " + VERSION)
@@ -1294,7 +2255,11 @@ def main():
 
     if len(sys.argv) >= 3:
         if sys.argv[1] == "test":
-            internaltest(sys.argv[2])
+            # test <folder> [workers]
+            return internaltest(sys.argv[2], int(sys.argv[3]) \
+                if len(sys.argv) > 3 else None)
+        if sys.argv[1] == "bench":
+            bench(sys.argv[2])
             return
 
     parser = argparse.ArgumentParser(epilog = \
@@ -1324,6 +2289,9 @@ def main():
         dest = "encoding", help = "output encoding (default: UTF-8)")
     parser_comp.add_argument('-te', "--trace-error", action = 'store_true', \
         help = "trace syntax error")
+    parser_comp.add_argument('-i', "--incremental", action = 'store_true', \
+        help = "reuse unchanged records from previous compile into same "\
+        "folder")
     parser_comp.add_argument('sourcepath', help = "path to SOURCE.TXT file")
     parser_comp.add_argument('destfolder', help = "path to output folder")
     parser_comp.set_defaults(func = action_comp)
@@ -1355,12 +2323,70 @@ def main():
     parser_compd.add_argument('destfolder', help = "path to output folder")
     parser_compd.set_defaults(func = action_compd)
 
+    # extract - <store.str> <destination folder> [-w <workers>]
+    parser_ext = subparsers.add_parser("extract", aliases = ['x'], \
+        help = "extract all files from STR store")
+    parser_ext.add_argument('-fo', action = 'store_true', \
+        help = "force write into not empty folder")
+    parser_ext.add_argument('-w', "--workers", action = 'store', \
+        dest = "workers", type = int, default = 4, \
+        help = "number of writer threads (default: 4)")
+    parser_ext.add_argument('sourcepath', help = "path to .STR file")
+    parser_ext.add_argument('destfolder', help = "path to output folder")
+    parser_ext.set_defaults(func = action_extract)
+
+    # pack - <source folder> <store.str> [-b <base.str>]
+    parser_pack = subparsers.add_parser("pack", aliases = ['p'], \
+        help = "pack folder into STR store")
+    parser_pack.add_argument('-fo', action = 'store_true', \
+        help = "force overwrite existing output file")
+    parser_pack.add_argument('-b', "--base", action = 'store', \
+        dest = "base", help = "base .STR file, records not found in folder "\
+        "copied from it")
+    parser_pack.add_argument('sourcefolder', help = "path to input folder")
+    parser_pack.add_argument('destpath', help = "path to output .STR file")
+    parser_pack.set_defaults(func = action_pack)
+
+    # preload - <game folder> [-w <workers>]
+    parser_pre = subparsers.add_parser("preload", \
+        help = "load all parts in parallel and compare with serial load")
+    parser_pre.add_argument('-w', "--workers", action = 'store', \
+        dest = "workers", type = int, default = None, \
+        help = "number of worker processes (default: CPU count)")
+    parser_pre.add_argument('-e', "--enc", action = 'store', \
+        dest = "encoding", help = "game encoding (default: cp1251)")
+    parser_pre.add_argument('--columnar', action = 'store_true', \
+        help = "keep script ops in columns")
+    parser_pre.add_argument('sourcefolder', help = "path to game folder")
+    parser_pre.set_defaults(func = action_preload)
+
+    # batch - <manifest | folder> [-o <output folder>] [-w <workers>]
+    parser_batch = subparsers.add_parser("batch", aliases = ['b'], \
+        help = "run compile/decompile jobs from manifest or folder tree")
+    parser_batch.add_argument('-fo', action = 'store_true', \
+        help = "run all jobs, even with unchanged inputs")
+    parser_batch.add_argument('-o', action = 'store', dest = "destfolder", \
+        help = "output folder for folder input")
+    parser_batch.add_argument('--compile', action = 'store_true', \
+        help = "compile script.txt/dialogue.txt from folder input "\
+        "(default: decompile)")
+    parser_batch.add_argument('-i', "--incremental", action = 'store_true', \
+        help = "incremental compile for script jobs")
+    parser_batch.add_argument('-w', "--workers", action = 'store', \
+        dest = "workers", type = int, default = None, \
+        help = "number of worker processes (default: CPU count)")
+    parser_batch.add_argument('-e', "--enc", action = 'store', \
+        dest = "encoding", help = "sources encoding (default: UTF-8)")
+    parser_batch.add_argument('source', help = "path to manifest file "\
+        "(lines: <action> <source> <destination>) or folder")
+    parser_batch.set_defaults(func = action_batch)
+
     # version
     parser_version = subparsers.add_parser("version", help = "program version")
     parser_version.set_defaults(func = action_version)
 
     args = parser.parse_args()
-    args.func(args)
+    return args.func(args)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -2,9 +2,10 @@
 class EngineError(Exception): pass
 
 from .engine import Engine, OPCODES, DLGOPS, ACTIONS
-from .fman import FileManager
+from .fman import FileManager, MemStream, StoreWriter
 from .imgbmp import BMPLoader
 from .imgflc import FLCLoader
 from .imgleg import LEGLoader
 from .imgmsk import MSKLoader
+from .imgcache import ImageCache
 from .saves import SaveLoader
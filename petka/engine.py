@@ -2,9 +2,21 @@
 
 # romiq.kh@gmail.com, 2014
 
-import os
+import os, sys
 import struct
 import io
+import array
+import bisect
+import collections
+import concurrent.futures
+import zlib
+import pickle
+import mmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from .fman import FileManager
 from . import EngineError
@@ -91,14 +103,56 @@ ACTIONS = {
 
 }
 
+# Engine attributes loaded by open_part
+PART_ATTRS = [
+    "curr_part", "curr_chap", "curr_path", "curr_speech", "curr_diskid",
+    "objects", "scenes", "obj_idx", "scn_idx", "obj_names", "scn_names",
+    "opcols", "res", "resord", "bgs_ini", "start_scene", "names", "namesord",
+    "names_pos", "invntr", "invntrord", "invntr_pos", "casts", "castsord",
+    "casts_pos", "msgs", "dlgs", "dlg_idx", "dlgops",
+    "xref_scenes", "xref_ops", "xref_res", "xref_dlgs", "xref_msgs",
+    "xref_msgdlg",
+]
+
+# part snapshot: header, pickled source stamps, pickled part model
+SNAP_HEADER = struct.Struct("<4sII")
+SNAP_VERSION = 6
+# part model without PARTS.INI values, set by load_part_stores
+SNAP_ATTRS = [attr for attr in PART_ATTRS if attr[:5] != "curr_"]
+# files parsed by open_part, relative to part path
+SNAP_FILES = ["script.dat", "backgrnd.bg", "resource.qrc", "names.ini",
+    "invntr.txt", "cast.ini", "bgs.ini", "dialogue.lod", "dialogue.fix"]
+
+# SCRIPT.DAT records
+SCR_HDR = struct.Struct("<II")
+SCR_REC = struct.Struct("<HI")
+SCR_NUM = struct.Struct("<I")
+SCR_ACT = struct.Struct("<HBHI")
+SCR_OP = struct.Struct("<5H")
+# BACKGRND.BG records
+BKG_REC = struct.Struct("<HI")
+BKG_REF = struct.Struct("<H5I")
+# DIALOGUE.LOD records
+LOD_MSG = struct.Struct("<I12sII")
+# DIALOGUE.FIX records
+FIX_GRP = struct.Struct("<3I")
+FIX_ACT = struct.Struct("<2H3I")
+FIX_DLG = struct.Struct("<3I")
+FIX_OP = struct.Struct("<HBB")
+
 class ScrObject:
+    __slots__ = ("idx", "name", "acts", "cast", "refs", "entareas", "persp")
     def __init__(self, idx, name):
         self.idx = idx
         self.name = name
         self.acts = None # action hadlers
         self.cast = None # object color (CASTS.INI)
+        self.refs = None # scene: objects references (BACKGRND.BG)
+        self.entareas = None # scene: enter areas (BGS.INI)
+        self.persp = None # scene: perspective (BGS.INI)
 
 class ScrActObject:
+    __slots__ = ("act_op", "act_status", "act_ref", "ops")
     def __init__(self, act_op, act_status, act_ref):
         self.act_op = act_op         # handler: opcode filter
         self.act_status = act_status # handler: status filter
@@ -106,6 +160,7 @@ class ScrActObject:
         self.ops = None              # operations
 
 class ScrOpObject:
+    __slots__ = ("op_ref", "op_code", "op_arg1", "op_arg2", "op_arg3")
     def __init__(self, op_ref, op_code, op_arg1, op_arg2, op_arg3):
         self.op_ref = op_ref # object idx
         self.op_code = op_code # opcode
@@ -113,13 +168,117 @@ class ScrOpObject:
         self.op_arg2 = op_arg2
         self.op_arg3 = op_arg3
 
+# script ops as parallel columns, ops of action are consecutive
+class OpColumns:
+    def __init__(self):
+        self.op_ref = array.array("H")
+        self.op_code = array.array("H")
+        self.op_arg1 = array.array("H")
+        self.op_arg2 = array.array("H")
+        self.op_arg3 = array.array("H")
+        self.act_start = array.array("I") # first op of action, + end mark
+        self.act_rec = array.array("I")   # record of action (objects + scenes)
+        self.act_num = array.array("H")   # action index in record
+
+    def load_raw(self, raw):
+        # raw - packed "<5H" records
+        arr = array.array("H", bytes(raw))
+        if sys.byteorder == "big":
+            arr.byteswap()
+        self.op_ref = arr[0::5]
+        self.op_code = arr[1::5]
+        self.op_arg1 = arr[2::5]
+        self.op_arg2 = arr[3::5]
+        self.op_arg3 = arr[4::5]
+
+    def pack_raw(self, start, end):
+        # ops range as packed "<5H" records
+        arr = array.array("H", bytes((end - start) * 10))
+        arr[0::5] = self.op_ref[start:end]
+        arr[1::5] = self.op_code[start:end]
+        arr[2::5] = self.op_arg1[start:end]
+        arr[3::5] = self.op_arg2[start:end]
+        arr[4::5] = self.op_arg3[start:end]
+        if sys.byteorder == "big":
+            arr.byteswap()
+        return arr.tobytes()
+
+    def append(self, op):
+        self.op_ref.append(op.op_ref)
+        self.op_code.append(op.op_code)
+        self.op_arg1.append(op.op_arg1)
+        self.op_arg2.append(op.op_arg2)
+        self.op_arg3.append(op.op_arg3)
+
+    def find(self, col, value):
+        # positions of value in column
+        if not isinstance(value, int) or value < 0 or value > 0xffff:
+            return []
+        if numpy:
+            arr = numpy.frombuffer(col, dtype = numpy.uint16)
+            return numpy.flatnonzero(arr == value).tolist()
+        data = col.tobytes()
+        pat = struct.pack("=H", value)
+        res = []
+        pos = data.find(pat)
+        while pos >= 0:
+            if pos % 2:
+                pos = data.find(pat, pos + 1)
+            else:
+                res.append(pos // 2)
+                pos = data.find(pat, pos + 2)
+        return res
+
+    def count(self, col):
+        # value -> count
+        if numpy and len(col):
+            cnt = numpy.bincount(numpy.frombuffer(col, dtype = numpy.uint16))
+            return dict((int(k), int(cnt[k])) for k in numpy.flatnonzero(cnt))
+        return dict(collections.Counter(col))
+
+    def locate(self, pos):
+        # op position -> action number
+        return bisect.bisect_right(self.act_start, pos, 0,
+            len(self.act_rec)) - 1
+
+    def op(self, pos):
+        return ScrOpObject(self.op_ref[pos], self.op_code[pos],
+            self.op_arg1[pos], self.op_arg2[pos], self.op_arg3[pos])
+
+# lazy list of ScrOpObject over OpColumns range
+class OpsView:
+    def __init__(self, cols, start, end):
+        self.cols = cols
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.cols.op(self.start + i) for i in \
+                range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("op index out of range")
+        return self.cols.op(self.start + idx)
+
+    def __iter__(self):
+        for i in range(self.start, self.end):
+            yield self.cols.op(i)
+
 class ScrObjectState:
+    __slots__ = ("obj", "state", "prop")
     def __init__(self, obj):
         self.obj = obj
         self.state = 0
         self.prop = [0] * 8
 
 class MsgObject:
+    __slots__ = ("idx", "msg_wav", "msg_arg1", "msg_arg2", "msg_arg3", "name",
+        "obj")
     def __init__(self, idx, wav, arg1, arg2, arg3):
         self.idx = idx
         self.msg_wav = wav   # wav filename
@@ -127,14 +286,18 @@ class MsgObject:
         self.msg_arg2 = arg2
         self.msg_arg3 = arg3
         self.name = None
+        self.obj = None      # object by arg1
 
 class DlgGrpObject:
+    __slots__ = ("idx", "grp_arg1", "acts", "num_acts")
     def __init__(self, idx, arg1):
         self.idx = idx
         self.grp_arg1 = arg1
         self.acts = None # dialog handlers
+        self.num_acts = 0
 
 class DlgActObject:
+    __slots__ = ("opcode", "ref", "arg1", "arg2", "dlgs", "obj", "num_dlgs")
     def __init__(self, opcode, ref, arg1, arg2):
         self.opcode = opcode # handler: opcode filter
         self.ref = ref       # handler: object idx filter
@@ -142,8 +305,10 @@ class DlgActObject:
         self.arg2 = arg2
         self.dlgs = None     # dialogs
         self.obj = None      # handler object
+        self.num_dlgs = 0
 
 class DlgObject:
+    __slots__ = ("op_start", "arg1", "arg2", "ops")
     def __init__(self, op_start, arg1, arg2):
         self.op_start = op_start # start position
         self.arg1 = arg1
@@ -151,6 +316,7 @@ class DlgObject:
         self.ops = None          # operations list
 
 class DlgOpObject:
+    __slots__ = ("opcode", "arg", "ref", "msg", "pos")
     def __init__(self, opcode, arg, ref):
         self.opcode = opcode    # dialog opcode
         self.arg = arg          # argument (ref, offset etc.)
@@ -173,49 +339,65 @@ class Engine:
         self.curr_speech = None
         self.curr_diskid = None
 
+        # keep script ops in columns, act.ops are views
+        self.columnar = False
+        self.opcols = None
+
+        # resident parts: max parts in memory (0 - only current)
+        self.resident = 0
+        # (part, chap) -> (attrs, part stores), least recently used first
+        self.resident_parts = collections.OrderedDict()
+
+        # folder for part snapshots (None - disabled)
+        self.snapdir = None
+
     def init_empty(self, enc):
         self.enc = enc
         self.objects = []
         self.scenes = []
         self.obj_idx = {} # id -> object
         self.scn_idx = {} # id -> scene
+        self.obj_names = {} # name -> [object, ...]
+        self.scn_names = {} # name -> [scene, ...]
         self.msgs = []
         self.dlgs = []
         self.dlg_idx = {}
         self.dlgops = []
+        self.opcols = None
 
-    def parse_ini(self, f):
-        # parse ini settings
+    def parse_ini(self, f, order = None):
+        # parse ini settings, sections and keys in file order
+        # order - dict, filled with section -> keys list and
+        # None -> sections list, duplicates kept
+        if order is None:
+            order = {}
         curr_sect = None
         ini = {}
-        order_sect = []
-        orders = {}
-        for line in f.readlines():
-            line = line.decode(self.enc).strip()
+        order[None] = sects = []
+        # decode once, iterate lines lazily
+        for line in io.StringIO(str(f.read(), self.enc)):
+            line = line.strip()
             if len(line) == 0: continue
             if line[:1] == ";": continue
             if line[:1] == "[" and line[-1:] == "]":
-                if curr_sect is not None:
-                    orders[curr_sect] = order
-                curr_sect = line[1:-1].strip()
-                order_sect.append(curr_sect)
-                order = []
-                ini[curr_sect] = {}
+                name = line[1:-1].strip()
+                sects.append(name)
+                curr_sect = {}
+                ini[name] = curr_sect
+                order[name] = keys = []
                 continue
             kv = line.split("=", 1)
-            if len(kv) != 2: continue
-            ini[curr_sect][kv[0].strip()] = kv[1].strip()
-            order.append(kv[0].strip())
-        orders[curr_sect] = order
-        ini["__ordersect__"] = order_sect
-        ini["__order__"] = orders
+            if len(kv) != 2 or curr_sect is None: continue
+            curr_sect[kv[0].strip()] = kv[1].strip()
+            keys.append(kv[0].strip())
         return ini
 
     def parse_res(self, f):
-        res  = {}
+        # res_id -> file name, ids in file order with duplicates
+        res = {}
         resord = []
-        for line in f.readlines():
-            line = line.decode(self.enc).strip()
+        for line in io.StringIO(str(f.read(), self.enc)):
+            line = line.strip()
             if len(line) == 0:
                 continue
             pair = line.split("=", 1)
@@ -229,18 +411,22 @@ class Engine:
             resord.append(res_id)
         return res, resord
 
-    def load_data(self, folder, enc):
+    def load_data(self, folder, enc, fman = None):
+        # fman - preconfigured FileManager for folder (e.g. with mmap)
         self.init_empty(enc)
-        self.fman = FileManager(folder)
+        if fman is None:
+            fman = FileManager(folder)
+        self.fman = fman
         # load PARTS.INI
         pf = self.fman.find_path("parts.ini")
         if pf:
             f = open(pf, "rb")
+            order = {}
             try:
-                self.parts_ini = self.parse_ini(f)
+                self.parts_ini = self.parse_ini(f, order)
             finally:
                 f.close()
-            for sect in self.parts_ini["__ordersect__"]:
+            for sect in order[None]:
                 data = self.parts_ini[sect]
                 if sect == "All":
                     if "Part" in data:
@@ -257,7 +443,56 @@ class Engine:
         self.fman.load_store("patch.str")
         self.fman.load_store("main.str")
 
+    def stash_part(self, part, chap):
+        # resident mode: keep current part with its stores, evict least
+        # recently used, return (attrs, stores) of part removed from cache
+        if self.curr_part is not None and \
+                (part, chap) != (self.curr_part, self.curr_chap):
+            self.resident_parts[(self.curr_part, self.curr_chap)] = \
+                (dict([(attr, getattr(self, attr, None)) \
+                    for attr in PART_ATTRS]), self.fman.detach_stores(1))
+        rp = self.resident_parts.pop((part, chap), None)
+        # one slot for current
+        while len(self.resident_parts) > self.resident - 1:
+            _, (_, stores) = self.resident_parts.popitem(last = False)
+            self.fman.close_stores(stores)
+        return rp
+
     def open_part(self, part, chap):
+        if self.resident > 0:
+            if (part, chap) == (self.curr_part, self.curr_chap):
+                self.reset_state()
+                return
+            rp = self.stash_part(part, chap)
+            if rp:
+                attrs, stores = rp
+                self.fman.attach_stores(stores)
+                for attr, value in attrs.items():
+                    setattr(self, attr, value)
+                self.reset_state()
+                return
+        self.load_part_stores(part, chap)
+        model = self.load_snapshot()
+        if model:
+            # linked model with backreferences
+            for attr, value in model.items():
+                setattr(self, attr, value)
+            self.reset_state()
+            return
+        # load script.dat, backgrnd.bg, resources.qrc, etc
+        self.load_script()
+        # load persp & scenes enter points
+        self.load_bgs()
+        # load names & invntr
+        self.load_names()
+        # load dialogs
+        self.load_dialogs()
+        # backreferences
+        self.build_xref()
+        self.reset_state()
+        self.save_snapshot()
+
+    def load_part_stores(self, part, chap):
         self.fman.unload_stores(1)
         self.curr_part = part
         self.curr_chap = chap
@@ -284,15 +519,122 @@ class Engine:
         for strf in strs:
             if strf in ini:
                 self.fman.load_store(ini[strf], 1)
-        # load script.dat, backgrnd.bg, resources.qrc, etc
-        self.load_script()
-        # load persp & scenes enter points
-        self.load_bgs()
-        # load names & invntr
-        self.load_names()
-        # load dialogs
-        self.load_dialogs()
 
+    def part_ids(self):
+        # (part, chap) for each "Part N [Chapter M]" section
+        ids = []
+        for name in self.parts:
+            pnum = name[5:]
+            cnum = pnum.split("Chapter", 1)
+            if len(cnum) > 1:
+                ids.append((int(cnum[0].strip(), 10), \
+                    int(cnum[1].strip(), 10)))
+            else:
+                ids.append((int(pnum.strip(), 10), 0))
+        return ids
+
+    def export_part(self):
+        # picklable part model, backreferences rebuilt by import_part
+        return dict([(attr, getattr(self, attr, None)) \
+            for attr in PART_ATTRS if attr[:5] != "xref_"])
+
+    def import_part(self, model):
+        if self.resident > 0:
+            # imported model replaces cached one
+            rp = self.stash_part(model["curr_part"], model["curr_chap"])
+            if rp:
+                self.fman.close_stores(rp[1])
+        self.load_part_stores(model["curr_part"], model["curr_chap"])
+        for attr, value in model.items():
+            setattr(self, attr, value)
+        self.build_xref()
+        self.reset_state()
+
+    def snapshot_path(self):
+        fn = "part{}-{}-{:08x}.snap".format(self.curr_part, self.curr_chap,
+            zlib.crc32(self.fman.root.encode("UTF-8")))
+        return os.path.join(self.snapdir, fn)
+
+    def snapshot_stamps(self):
+        # snapshot valid for same sources and load options
+        return [self.enc, self.columnar, self.curr_path] + \
+            [self.fman.file_stamp(self.curr_path + fn) for fn in SNAP_FILES]
+
+    def load_snapshot(self):
+        if not self.snapdir: return
+        try:
+            f = open(self.snapshot_path(), "rb")
+        except OSError:
+            return
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            f.close()
+            return
+        try:
+            magic, ver, stamps_len = SNAP_HEADER.unpack_from(mm)
+            if magic != b"PtSN" or ver != SNAP_VERSION:
+                return
+            off = SNAP_HEADER.size
+            if pickle.loads(mm[off:off + stamps_len]) != \
+                    self.snapshot_stamps():
+                return
+            print("DEBUG: Load part snapshot \"{}\"".format(
+                self.snapshot_path()))
+            with memoryview(mm) as view:
+                return pickle.loads(view[off + stamps_len:])
+        except Exception as e:
+            print("DEBUG: Bad part snapshot: " + str(e))
+        finally:
+            mm.close()
+            f.close()
+
+    def save_snapshot(self):
+        if not self.snapdir: return
+        stamps = pickle.dumps(self.snapshot_stamps(), pickle.HIGHEST_PROTOCOL)
+        path = self.snapshot_path()
+        try:
+            os.makedirs(self.snapdir, exist_ok = True)
+            # write aside, readers never see partial snapshot
+            with open(path + ".tmp", "wb") as f:
+                f.write(SNAP_HEADER.pack(b"PtSN", SNAP_VERSION, len(stamps)))
+                f.write(stamps)
+                pickle.dump(dict([(attr, getattr(self, attr, None)) \
+                    for attr in SNAP_ATTRS]), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print("DEBUG: Can't save part snapshot \"{}\": ".format(path) +
+                str(e))
+            try:
+                os.remove(path + ".tmp")
+            except OSError:
+                pass
+
+    def preload_parts(self, parts = None, workers = None):
+        # load parts in worker processes, (part, chap) -> model
+        # workers = 0 - load serially in this process
+        if parts is None:
+            parts = self.part_ids()
+        models = {}
+        if workers == 0:
+            for part, chap in parts:
+                models[(part, chap)] = load_part_model(self.fman.root, \
+                    self.enc, part, chap, self.columnar)
+            return models
+        with concurrent.futures.ProcessPoolExecutor(workers) as ex:
+            futs = [(key, ex.submit(load_part_model, self.fman.root, \
+                self.enc, key[0], key[1], self.columnar)) for key in parts]
+            for key, fut in futs:
+                models[key] = fut.result()
+        return models
+
+    def close_parts(self):
+        # drop resident parts except current
+        for _, stores in self.resident_parts.values():
+            self.fman.close_stores(stores)
+        self.resident_parts.clear()
+
+    def reset_state(self):
         # current state
         self.curr_scene = None
         self.curr_obj = None
@@ -302,47 +644,52 @@ class Engine:
         self.curr_char2 = None
         self.curr_invntr = None
 
-    def load_script(self, scrname = None, bkgname = None, resname = None):
+    def parse_script(self, data):
+        # single memoryview, records unpacked in place
         self.objects = []
         self.scenes = []
         self.obj_idx = {}
         self.scn_idx = {}
-
-        if scrname is None:
-            try:
-                data = self.fman.read_file(self.curr_path + "script.dat")
-            except:
-                raise EngineError("Can't open SCRIPT.DAT")
-        else:
-            try:
-                f = open(scrname, "rb")
-            except:
-                raise EngineError("Can't open SCRIPT.DAT")
-            try:
-                data = f.read()
-            finally:
-                f.close()
-        num_obj, num_scn = struct.unpack_from("<II", data[:8])
-        off = 8
+        self.obj_names = {}
+        self.scn_names = {}
+        self.opcols = None
+        cols = OpColumns() if self.columnar else None
+        raw = bytearray()
+        data = memoryview(data)
+        enc = self.enc
+        rec_unpack = SCR_REC.unpack_from
+        num_unpack = SCR_NUM.unpack_from
+        act_unpack = SCR_ACT.unpack_from
+        op_iter = SCR_OP.iter_unpack
+        num_obj, num_scn = SCR_HDR.unpack_from(data)
+        off = SCR_HDR.size
         def read_rec(off):
-            obj_id, name_len = struct.unpack_from("<HI", data[off:off + 6])
+            obj_id, name_len = rec_unpack(data, off)
             off += 6
-            name = data[off:off + name_len].decode(self.enc)
+            name = str(data[off:off + name_len], enc)
             off += name_len
-            num_act = struct.unpack_from("<I", data[off:off + 4])[0]
+            num_act = num_unpack(data, off)[0]
             off += 4
             acts = []
             for i in range(num_act):
-                act_op, act_status, act_ref, num_op = struct.unpack_from(\
-                    "<HBHI", data[off:off + 9])
+                act_op, act_status, act_ref, num_op = act_unpack(data, off)
                 off += 9
                 act = ScrActObject(act_op, act_status, act_ref)
-                act.ops = []
-                for j in range(num_op):
-                    op = struct.unpack_from("<5H", data[off:off + 10])
-                    off += 10
-                    op = ScrOpObject(*op)
-                    act.ops.append(op)
+                # whole op run at once
+                end = off + num_op * 10
+                if end > len(data):
+                    raise EngineError("SCRIPT.DAT truncated")
+                if cols is not None:
+                    start = len(raw) // 10
+                    cols.act_start.append(start)
+                    cols.act_rec.append(len(self.objects) + len(self.scenes))
+                    cols.act_num.append(i)
+                    raw[len(raw):] = data[off:end]
+                    act.ops = OpsView(cols, start, start + num_op)
+                else:
+                    act.ops = [ScrOpObject(*op) for op in \
+                        op_iter(data[off:end])]
+                off = end
                 acts.append(act)
             rec = ScrObject(obj_id, name)
             rec.acts = acts
@@ -352,35 +699,122 @@ class Engine:
             off, obj = read_rec(off)
             self.objects.append(obj)
             self.obj_idx[obj.idx] = obj
+            self.obj_names.setdefault(obj.name, []).append(obj)
 
         for i in range(num_scn):
             off, scn = read_rec(off)
             scn.refs = None
             self.scenes.append(scn)
             self.scn_idx[scn.idx] = scn
+            self.scn_names.setdefault(scn.name, []).append(scn)
 
-        if bkgname is None:
-            try:
-                data = self.fman.read_file(self.curr_path + "backgrnd.bg")
-            except:
-                data = None
-        else:
-            try:
-                f = open(bkgname, "rb")
-            except:
-                data = None
-            try:
-                data = f.read()
-            finally:
-                f.close()
+        if cols is not None:
+            cols.act_start.append(len(raw) // 10)
+            cols.load_raw(raw)
+            self.opcols = cols
 
-        if data:
-            num_rec = struct.unpack_from("<I", data[:4])[0]
-        else:
-            num_rec = 0
+    def build_columns(self):
+        # columns for list based ops (not columnar load, compiled script)
+        cols = OpColumns()
+        for ridx, rec in enumerate(self.objects + self.scenes):
+            for aidx, act in enumerate(rec.acts):
+                cols.act_start.append(len(cols.op_code))
+                cols.act_rec.append(ridx)
+                cols.act_num.append(aidx)
+                for op in act.ops:
+                    cols.append(op)
+        cols.act_start.append(len(cols.op_code))
+        return cols
+
+    def op_columns(self):
+        # columnar mode owns opcols, otherwise built from current records
+        if self.columnar and self.opcols is not None:
+            return self.opcols
+        return self.build_columns()
+
+    def find_ops(self, op_code = None, op_ref = None, op_arg1 = None):
+        # column scan, return [(record, action index, op index), ...]
+        # in objects + scenes order
+        cols = self.op_columns()
+        conds = [(col, val) for col, val in [(cols.op_code, op_code),
+            (cols.op_ref, op_ref), (cols.op_arg1, op_arg1)] \
+            if val is not None]
+        if not conds:
+            return []
+        col, val = conds[0]
+        found = cols.find(col, val)
+        for col, val in conds[1:]:
+            found = [pos for pos in found if col[pos] == val]
+        recs = self.objects + self.scenes
+        res = []
+        for pos in found:
+            anum = cols.locate(pos)
+            res.append((recs[cols.act_rec[anum]], cols.act_num[anum],
+                pos - cols.act_start[anum]))
+        return res
+
+    def build_xref(self):
+        # reverse references in one pass, lists in objects + scenes order
+        self.xref_scenes = {} # object idx -> scenes refer to object
+        self.xref_ops = {}    # object idx -> [(record, action, op), ...]
+        self.xref_res = {}    # resource id -> records
+        self.xref_dlgs = {}   # dialog group idx -> records with DIALOG op
+        self.xref_msgs = {}   # object idx -> messages
+        self.xref_msgdlg = {} # message idx -> dialog groups (per op)
+        def add(xref, key, rec):
+            lst = xref.get(key)
+            if lst is None:
+                xref[key] = [rec]
+            elif lst[-1] is not rec:
+                lst.append(rec)
+
+        for scn in self.scenes:
+            for ref in scn.refs or []:
+                add(self.xref_scenes, ref[0].idx, scn)
+
+        cols = self.op_columns()
+        recs = self.objects + self.scenes
+        res = getattr(self, "res", {})
+        op_ref = cols.op_ref
+        op_code = cols.op_code
+        op_arg1 = cols.op_arg1
+        for anum in range(len(cols.act_rec)):
+            rec = recs[cols.act_rec[anum]]
+            aidx = cols.act_num[anum]
+            start = cols.act_start[anum]
+            for pos in range(start, cols.act_start[anum + 1]):
+                ref = op_ref[pos]
+                opl = self.xref_ops.get(ref)
+                if opl is None:
+                    self.xref_ops[ref] = opl = []
+                opl.append((rec, aidx, pos - start))
+                if op_arg1[pos] in res:
+                    add(self.xref_res, op_arg1[pos], rec)
+                if op_code[pos] == 0x11: # DIALOG
+                    add(self.xref_dlgs, ref, rec)
+
+        for msg in self.msgs:
+            if msg.obj is not None:
+                self.xref_msgs.setdefault(msg.obj.idx, []).append(msg)
+        for grp in self.dlgs:
+            for act in grp.acts:
+                for dlg in act.dlgs:
+                    for op in dlg.ops:
+                        if op.opcode == 7 and op.msg: # PLAY
+                            self.xref_msgdlg.setdefault(op.msg.idx,
+                                []).append(grp)
+
+    def count_ops(self):
+        # op_code -> ops count
+        cols = self.op_columns()
+        return cols.count(cols.op_code)
+
+    def parse_backgrnd(self, data):
+        data = memoryview(data)
+        num_rec = SCR_NUM.unpack_from(data)[0]
         off = 4
         for i in range(num_rec):
-            scn_ref, num_ref = struct.unpack_from("<HI", data[off:off + 6])
+            scn_ref, num_ref = BKG_REC.unpack_from(data, off)
             off += 6
             if scn_ref in self.scn_idx:
                 scn = self.scn_idx[scn_ref]
@@ -389,19 +823,59 @@ class Engine:
                 raise EngineError("DEBUG: Scene ID = 0x{:x} not found".\
                     format(scn_ref))
 
-            for j in range(num_ref):
-                ref = struct.unpack_from("<H5I", data[off:off + 22])
-                off += 22
+            end = off + num_ref * 22
+            if end > len(data):
+                raise EngineError("BACKGRND.BG truncated")
+            for ref in BKG_REF.iter_unpack(data[off:end]):
                 if ref[0] in self.obj_idx:
                     obj = self.obj_idx[ref[0]]
                     scn.refs.append([obj] + list(ref[1:]))
                 else:
                     raise EngineError("DEBUG: Scene ref 0x{:x} not found".\
-                        format(obj[0]))
+                        format(ref[0]))
+            off = end
+
+    def load_script(self, scrname = None, bkgname = None, resname = None):
+        if scrname is None:
+            try:
+                data = self.fman.read_file(self.curr_path + "script.dat",
+                    True)
+            except:
+                raise EngineError("Can't open SCRIPT.DAT")
+        else:
+            try:
+                f = open(scrname, "rb")
+            except:
+                raise EngineError("Can't open SCRIPT.DAT")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        self.parse_script(data)
+
+        if bkgname is None:
+            try:
+                data = self.fman.read_file(self.curr_path + "backgrnd.bg",
+                    True)
+            except:
+                data = None
+        else:
+            try:
+                f = open(bkgname, "rb")
+            except:
+                data = None
+            try:
+                data = f.read()
+            finally:
+                f.close()
+
+        if data:
+            self.parse_backgrnd(data)
 
         if resname is None:
             try:
-                f = self.fman.read_file_stream(self.curr_path + "resource.qrc")
+                f = self.fman.read_file_stream(self.curr_path + \
+                    "resource.qrc", True)
             except:
                 f = None
         else:
@@ -424,53 +898,67 @@ class Engine:
         self.namesord = []
         fp = self.curr_path + "names.ini"
         if self.fman.exists(fp):
-            f = self.fman.read_file_stream(fp)
-            ini = self.parse_ini(f)
+            f = self.fman.read_file_stream(fp, True)
+            order = {}
+            ini = self.parse_ini(f, order)
             self.names = ini["all"]
-            self.namesord = ini["__order__"]["all"]
+            self.namesord = order["all"]
             f.close()
 
         self.invntr = {}
         self.invntrord = []
         fp = self.curr_path + "invntr.txt"
         if self.fman.exists(fp):
-            f = self.fman.read_file_stream(fp)
-            ini = self.parse_ini(f)
+            f = self.fman.read_file_stream(fp, True)
+            order = {}
+            ini = self.parse_ini(f, order)
             self.invntr = ini["ALL"]
-            self.invntrord = ini["__order__"]["ALL"]
+            self.invntrord = order["ALL"]
             f.close()
 
         self.casts = {}
         self.castsord = []
         fp = self.curr_path + "cast.ini"
         if self.fman.exists(fp):
-            f = self.fman.read_file_stream(fp)
-            ini = self.parse_ini(f)
+            f = self.fman.read_file_stream(fp, True)
+            order = {}
+            ini = self.parse_ini(f, order)
             self.casts = ini["all"]
-            self.castsord = ini["__order__"]["all"]
+            self.castsord = order["all"]
             f.close()
 
+        # first position of each key
+        self.names_pos = self.build_pos(self.namesord)
+        self.invntr_pos = self.build_pos(self.invntrord)
+        self.casts_pos = self.build_pos(self.castsord)
+
         # bind casts to objects
-        for obj in self.objects:
-            if obj.name in self.casts:
-                # parse color
-                try:
-                    val = self.casts[obj.name].split(" ")
-                    val = [x for x in val if x]
-                    r = int(val[0])
-                    g = int(val[1])
-                    b = int(val[2])
-                except:
-                    r, g, b = 255, 255, 255
+        for name, value in self.casts.items():
+            # parse color
+            try:
+                val = value.split(" ")
+                val = [x for x in val if x]
+                r = int(val[0])
+                g = int(val[1])
+                b = int(val[2])
+            except:
+                r, g, b = 255, 255, 255
+            for obj in self.obj_names.get(name, []):
                 obj.cast = (r, g, b)
 
+    def build_pos(self, order):
+        pos = {}
+        for idx, key in enumerate(order):
+            pos.setdefault(key, idx)
+        return pos
+
     def load_bgs(self):
         # load BGS.INI
         self.bgs_ini = {}
         self.start_scene = None
         bgsfn = self.curr_path + "bgs.ini"
         if self.fman.exists(bgsfn):
-            f = self.fman.read_file_stream(bgsfn)
+            f = self.fman.read_file_stream(bgsfn, True)
             try:
                 self.bgs_ini = self.parse_ini(f)
             finally:
@@ -487,20 +975,12 @@ class Engine:
                 scene.entareas = []
                 for key in areas.keys():
                     # search scene
-                    sf = None
-                    for scenefrom in self.scenes:
-                        if scenefrom.name == key:
-                            sf = scenefrom
-                            break
+                    sf = self.scn_names.get(key)
                     value = areas[key]
                     # search objects
-                    oo = None
-                    for objon in self.objects:
-                        if objon.name == value:
-                            oo = objon
-                            break
+                    oo = self.obj_names.get(value)
                     if sf and oo:
-                        scene.entareas.append((sf, oo))
+                        scene.entareas.append((sf[0], oo[0]))
             # persp
             persp = settings.get(scene.name, "")
             persp = persp.split(" ")
@@ -632,60 +1112,130 @@ class Engine:
                     f.close()
 
     def write_script(self, f):
-        f.write(struct.pack("<II", len(self.objects), len(self.scenes)))
-
-        def write_rec(rec):
-            ename = rec.name.encode(self.enc)
-            f.write(struct.pack("<HI", rec.idx, len(ename)))
-            f.write(ename)
-            f.write(struct.pack("<I", len(rec.acts)))
+        # whole file packed into one buffer, single write
+        recs = [(rec, rec.name.encode(self.enc)) for rec in \
+            self.objects + self.scenes]
+        size = SCR_HDR.size
+        for rec, ename in recs:
+            size += SCR_REC.size + len(ename) + SCR_NUM.size
             for act in rec.acts:
-                f.write(struct.pack("<HBHI", act.act_op, act.act_status,
-                    act.act_ref, len(act.ops)))
-                for op in act.ops:
-                    f.write(struct.pack("<5H", op.op_ref, op.op_code,
-                        op.op_arg1, op.op_arg2, op.op_arg3))
+                size += SCR_ACT.size + SCR_OP.size * len(act.ops)
+        buf = bytearray(size)
+        rec_pack = SCR_REC.pack_into
+        num_pack = SCR_NUM.pack_into
+        act_pack = SCR_ACT.pack_into
+        op_pack = SCR_OP.pack_into
+        rawcols = None
+        SCR_HDR.pack_into(buf, 0, len(self.objects), len(self.scenes))
+        off = SCR_HDR.size
+        for rec, ename in recs:
+            rec_pack(buf, off, rec.idx, len(ename))
+            off += SCR_REC.size
+            buf[off:off + len(ename)] = ename
+            off += len(ename)
+            num_pack(buf, off, len(rec.acts))
+            off += SCR_NUM.size
+            for act in rec.acts:
+                act_pack(buf, off, act.act_op, act.act_status, act.act_ref,
+                    len(act.ops))
+                off += SCR_ACT.size
+                ops = act.ops
+                if isinstance(ops, OpsView):
+                    # columns interleaved once, ops copied as slices
+                    if ops.cols is not rawcols:
+                        rawcols = ops.cols
+                        raw = memoryview(rawcols.pack_raw(0,
+                            len(rawcols.op_ref)))
+                    end = off + SCR_OP.size * len(ops)
+                    buf[off:end] = raw[ops.start * SCR_OP.size:\
+                        ops.end * SCR_OP.size]
+                    off = end
+                    continue
+                for op in ops:
+                    op_pack(buf, off, op.op_ref, op.op_code, op.op_arg1,
+                        op.op_arg2, op.op_arg3)
+                    off += SCR_OP.size
+        f.write(buf)
 
-        for rec in self.objects + self.scenes:
-            write_rec(rec)
+    def pack_rec(self, rec):
+        # single SCRIPT.DAT record, as written by write_script
+        ename = rec.name.encode(self.enc)
+        buf = [SCR_REC.pack(rec.idx, len(ename)), ename,
+            SCR_NUM.pack(len(rec.acts))]
+        for act in rec.acts:
+            buf.append(SCR_ACT.pack(act.act_op, act.act_status, act.act_ref,
+                len(act.ops)))
+            buf.extend([SCR_OP.pack(op.op_ref, op.op_code, op.op_arg1,
+                op.op_arg2, op.op_arg3) for op in act.ops])
+        return b"".join(buf)
+
+    def pack_bkg(self, scn):
+        # single BACKGRND.BG record, as written by write_backgrnd
+        return BKG_REC.pack(scn.idx, len(scn.refs)) + b"".join([
+            BKG_REF.pack(ref[0].idx, ref[1], ref[2], ref[3], ref[4], ref[5])
+            for ref in scn.refs])
 
     def write_backgrnd(self, f):
         lst = [scn for scn in self.scenes if scn.refs is not None]
-        f.write(struct.pack("<I", len(lst)))
+        buf = bytearray(SCR_NUM.size + sum([BKG_REC.size + \
+            BKG_REF.size * len(scn.refs) for scn in lst]))
+        ref_pack = BKG_REF.pack_into
+        SCR_NUM.pack_into(buf, 0, len(lst))
+        off = SCR_NUM.size
         for scn in lst:
-            f.write(struct.pack("<HI", scn.idx, len(scn.refs)))
+            BKG_REC.pack_into(buf, off, scn.idx, len(scn.refs))
+            off += BKG_REC.size
             for ref in scn.refs:
-                f.write(struct.pack("<H5I", ref[0].idx, ref[1], ref[2],
-                    ref[3], ref[4], ref[5]))
-
+                ref_pack(buf, off, ref[0].idx, ref[1], ref[2], ref[3],
+                    ref[4], ref[5])
+                off += BKG_REF.size
+        f.write(buf)
 
     def write_lod(self, f):
-        f.write(struct.pack("<I", len(self.msgs)))
+        # wav names padded with zeros by 12s
+        buf = bytearray(SCR_NUM.size + LOD_MSG.size * len(self.msgs))
+        msg_pack = LOD_MSG.pack_into
+        SCR_NUM.pack_into(buf, 0, len(self.msgs))
+        off = SCR_NUM.size
         for msg in self.msgs:
-            wav = msg.msg_wav.encode(self.enc)
-            while len(wav) < 12:
-                wav += b"\0"
-            f.write(struct.pack("<I12sII", msg.msg_arg1, wav, msg.msg_arg2,
-                msg.msg_arg3))
-        for msg in self.msgs:
-            txt = msg.name.encode(self.enc)
-            f.write(txt + b"\0")
+            msg_pack(buf, off, msg.msg_arg1, msg.msg_wav.encode(self.enc),
+                msg.msg_arg2, msg.msg_arg3)
+            off += LOD_MSG.size
+        buf += b"".join([msg.name.encode(self.enc) + b"\0" \
+            for msg in self.msgs])
+        f.write(buf)
 
     def write_fix(self, f):
-        f.write(struct.pack("<I", len(self.dlgs)))
+        size = SCR_NUM.size * 2 + FIX_GRP.size * len(self.dlgs) + \
+            FIX_OP.size * len(self.dlgops)
+        for grp in self.dlgs:
+            size += FIX_ACT.size * len(grp.acts)
+            for act in grp.acts:
+                size += FIX_DLG.size * len(act.dlgs)
+        buf = bytearray(size)
+        act_pack = FIX_ACT.pack_into
+        dlg_pack = FIX_DLG.pack_into
+        op_pack = FIX_OP.pack_into
+        SCR_NUM.pack_into(buf, 0, len(self.dlgs))
+        off = SCR_NUM.size
         for grp in self.dlgs:
-            f.write(struct.pack("<3I", grp.idx, len(grp.acts), grp.grp_arg1))
+            FIX_GRP.pack_into(buf, off, grp.idx, len(grp.acts), grp.grp_arg1)
+            off += FIX_GRP.size
         for grp in self.dlgs:
             for act in grp.acts:
-                f.write(struct.pack("<2H3I", act.opcode, act.ref,
-                    len(act.dlgs), act.arg1, act.arg2))
+                act_pack(buf, off, act.opcode, act.ref, len(act.dlgs),
+                    act.arg1, act.arg2)
+                off += FIX_ACT.size
             for act in grp.acts:
                 for dlg in act.dlgs:
-                    f.write(struct.pack("<3I", dlg.op_start, dlg.arg1,
-                        dlg.arg2))
-        f.write(struct.pack("<I", len(self.dlgops)))
+                    dlg_pack(buf, off, dlg.op_start, dlg.arg1, dlg.arg2)
+                    off += FIX_DLG.size
+        SCR_NUM.pack_into(buf, off, len(self.dlgops))
+        off += SCR_NUM.size
         for op in self.dlgops:
-            f.write(struct.pack("<H2B", op.ref, op.arg, op.opcode))
+            op_pack(buf, off, op.ref, op.arg, op.opcode)
+            off += FIX_OP.size
+        f.write(buf)
 
     def scene_to_id(self, name):
         pass
@@ -720,3 +1270,14 @@ class Engine:
         self.curr_char1 = None
         self.curr_char2 = None
         self.curr_invntr = None
+
+def load_part_model(folder, enc, part, chap, columnar = False):
+    # worker for Engine.preload_parts
+    sim = Engine()
+    sim.columnar = columnar
+    sim.load_data(folder, enc)
+    try:
+        sim.open_part(part, chap)
+        return sim.export_part()
+    finally:
+        sim.fman.unload_stores()
@@ -2,49 +2,119 @@
 
 # romiq.kh@gmail.com, 2014
 
-import os
+import os, sys
 import struct
+import array
 import io
+import mmap
+import zlib
+import concurrent.futures
 
 from . import EngineError
 
+# index cache: magic, version, store size, store mtime, index len, path len
+IDX_HEADER = struct.Struct("<4sIQQII")
+IDX_VERSION = 1
+
+COPY_CHUNK = 1 << 20
+
+# read-only stream over buffer, read() return zero-copy memoryview slices
+class MemStream:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            end = len(self.data)
+        else:
+            end = min(self.pos + size, len(self.data))
+        data = self.data[self.pos:end]
+        self.pos = max(self.pos, end)
+        return data
+
+    def seek(self, pos, whence = 0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self.data)
+        self.pos = max(pos, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def getbuffer(self):
+        return self.data
+
+    def getvalue(self):
+        return self.data.tobytes()
+
+    def close(self):
+        pass
+
+# stream for libraries which expect bytes from read() (e.g. PIL)
+def bytes_stream(f):
+    if isinstance(f, MemStream):
+        return io.BytesIO(f.getvalue())
+    return f
+
 # manage files data
 class FileManager:
-    def __init__(self, root):
+    def __init__(self, root, usemmap = False, idxcache = None):
+        # idxcache - folder for stores index cache
         self.root = os.path.abspath(root)
+        self.usemmap = usemmap
+        self.idxcache = idxcache
 
         self.strfd = []
+        self.strmm = [] # (mmap, memoryview) for each store or None
         self.strtable = {}
         self.strtableord = []
+        self.dircache = {} # real folder path -> {lower name: real name}
+
+    def list_dir(self, path):
+        # lazy case insensive folder index, first listed name wins
+        lst = self.dircache.get(path)
+        if lst is None:
+            lst = {}
+            try:
+                for item in os.listdir(path):
+                    lst.setdefault(item.lower(), item)
+            except OSError:
+                pass
+            self.dircache[path] = lst
+        return lst
 
     def find_path(self, path):
         # search case insensive from root
-        dpath = []
         npath = self.root
         path = path.replace("\\", "/")
         for item in path.split("/"):
             if not item: continue
-            ok = False
-            for ritem in os.listdir(npath):
-                if item.lower() != ritem.lower(): continue
-                npath = os.path.join(npath, ritem)
-                ok = True
-                break
-            if not ok: return None
+            ritem = self.list_dir(npath).get(item.lower())
+            if ritem is None: return None
+            npath = os.path.join(npath, ritem)
         return npath
 
-    def load_store(self, name, tag = 0):
-        path = self.find_path(name)
-        if path is None:
-            print("DEBUG: Store \"{}\" not found".format(name))
-            return
-        # scan table
-        f = open(path, "rb")
+    def rescan(self, path = None):
+        # forget folders index after changes on disk, all or path subtree
+        if path is not None:
+            npath = self.find_path(path)
+            if npath is not None:
+                for key in list(self.dircache.keys()):
+                    if key == npath or key.startswith(npath + os.sep):
+                        del self.dircache[key]
+                self.dircache.pop(os.path.dirname(npath), None)
+                return
+        self.dircache = {}
+
+    def read_index(self, f, name):
+        # read store index: array of (pos, len) pairs and names list
         # check magic string "StOR"
         magic = f.read(4)
         if magic != b"StOR":
             raise EngineError("Bad magic in store \"{}\"".format(name))
-            return
         # read index table ref
         temp = f.read(4)
         index_ref = struct.unpack_from("<I", temp)[0]
@@ -52,18 +122,106 @@ class FileManager:
         # index table length
         temp = f.read(4)
         index_len = struct.unpack_from("<I", temp)[0]
-        index_table = []
-        for iref in range(index_len):
-            temp = f.read(12)
-            data = struct.unpack_from("<III", temp)
-            index_table.append((data[1], data[2]))
-        strlst = []
+        temp = f.read(index_len * 12)
+        if len(temp) != index_len * 12:
+            raise EngineError("Index table truncated in store \"{}\"".\
+                format(name))
+        table = array.array("I")
+        for _, st, ln in struct.iter_unpack("<III", temp):
+            table.append(st)
+            table.append(ln)
         data = f.read().decode("latin-1")
-        for idx, fname in enumerate(data.split("\x00")):
-            fname = fname.lower().replace("\\", "/")
+        fnames = data.lower().replace("\\", "/").split("\x00")
+        return table, fnames
+
+    def index_cache_path(self, path):
+        fn = "{}-{:08x}.idx".format(os.path.basename(path).lower(),
+            zlib.crc32(path.encode("UTF-8")))
+        return os.path.join(self.idxcache, fn)
+
+    def load_index_cache(self, f, path):
+        # cached index valid for same store path, size and mtime
+        if not self.idxcache: return
+        st = os.fstat(f.fileno())
+        try:
+            with open(self.index_cache_path(path), "rb") as cf:
+                data = cf.read()
+        except OSError:
+            return
+        try:
+            magic, ver, size, mtime, index_len, path_len = \
+                IDX_HEADER.unpack_from(data)
+            if magic != b"StIX" or ver != IDX_VERSION:
+                return
+            if size != st.st_size or mtime != st.st_mtime_ns:
+                return
+            off = IDX_HEADER.size
+            if data[off:off + path_len] != path.encode("UTF-8"):
+                return
+            off += path_len
+            table = array.array("I")
+            table.frombytes(data[off:off + index_len * 8])
+            if sys.byteorder != "little":
+                table.byteswap()
+            off += index_len * 8
+            fnames = data[off:].decode("latin-1").split("\x00")
+        except (struct.error, ValueError) as e:
+            print("DEBUG: Bad index cache for \"{}\": ".format(path) + str(e))
+            return
+        # truncated cache - rebuild
+        if len(table) != index_len * 2 or len(fnames) < index_len:
+            print("DEBUG: Truncated index cache for \"{}\"".format(path))
+            return
+        return table, fnames
+
+    def save_index_cache(self, f, path, table, fnames):
+        if not self.idxcache: return
+        st = os.fstat(f.fileno())
+        epath = path.encode("UTF-8")
+        ctable = array.array("I", table)
+        if sys.byteorder != "little":
+            ctable.byteswap()
+        # write to temp file, other processes may read cache
+        cpath = self.index_cache_path(path)
+        tmppath = "{}.{}.tmp".format(cpath, os.getpid())
+        try:
+            os.makedirs(self.idxcache, exist_ok = True)
+            with open(tmppath, "wb") as cf:
+                cf.write(IDX_HEADER.pack(b"StIX", IDX_VERSION, st.st_size,
+                    st.st_mtime_ns, len(table) // 2, len(epath)) + epath +
+                    ctable.tobytes() + "\x00".join(fnames).encode("latin-1"))
+            os.replace(tmppath, cpath)
+        except OSError as e:
+            print("DEBUG: Can't save index cache for \"{}\": ".format(path) +
+                str(e))
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+
+    def load_store(self, name, tag = 0):
+        path = self.find_path(name)
+        if path is None:
+            print("DEBUG: Store \"{}\" not found".format(name))
+            return
+        # scan table
+        f = open(path, "rb")
+        try:
+            index = self.load_index_cache(f, path)
+            if index is None:
+                index = self.read_index(f, name)
+                self.save_index_cache(f, path, *index)
+        except:
+            f.close()
+            raise
+        table, fnames = index
+        index_len = len(table) // 2
+        strlst = []
+        for idx, fname in enumerate(fnames):
             if idx < index_len and fname not in self.strtable:
-                self.strtable[fname] = (len(self.strfd),) + index_table[idx]
-                strlst.append((fname, len(self.strtableord)) + index_table[idx])
+                st, ln = table[idx * 2], table[idx * 2 + 1]
+                self.strtable[fname] = (len(self.strfd), st, ln)
+                strlst.append((fname, len(self.strtableord), st, ln))
                 self.strtableord.append(fname)
             else:
                 if len(fname) > 0:
@@ -71,16 +229,29 @@ class FileManager:
                         format(fname, name))
         # add file descriptor
         self.strfd.append((f, name, tag, strlst))
+        mm = None
+        if self.usemmap:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                mm = (m, memoryview(m))
+            except (ValueError, OSError) as e:
+                print("DEBUG: Can't mmap store \"{}\": ".format(name) + str(e))
+        self.strmm.append(mm)
         print("DEBUG: Loaded store \"{}\"".format(name))
 
-    def read_file(self, fname):
+    def read_file(self, fname, view = False):
+        # view - return memoryview (zero-copy for mmaped stores)
         sf = fname.lower().replace("\\", "/")
         if sf in self.strtable:
             fnum, st, ln = self.strtable[sf]
             print("Load file \"{}\" from store \"{}\"".\
                 format(fname, self.strfd[fnum][1]))
-            self.strfd[fnum][0].seek(st)
-            return self.strfd[fnum][0].read(ln)
+            if view and self.strmm[fnum]:
+                return self.strmm[fnum][1][st:st + ln]
+            data = self.read_store(fnum, st, ln)
+            if view:
+                return memoryview(data)
+            return data
         else:
             print("Load file \"{}\" from filesystem".format(fname))
             pf = self.find_path(fname)
@@ -92,9 +263,113 @@ class FileManager:
                 data = f.read()
             finally:
                 f.close()
+            if view:
+                return memoryview(data)
+            return data
+
+    def read_store(self, fnum, st, ln):
+        # read without shared file offset, safe for concurrent threads
+        mm = self.strmm[fnum]
+        if mm:
+            return mm[0][st:st + ln]
+        fd = self.strfd[fnum][0]
+        if hasattr(os, "pread"):
+            data = os.pread(fd.fileno(), ln, st)
+            while len(data) < ln:
+                temp = os.pread(fd.fileno(), ln - len(data), st + len(data))
+                if not temp: break
+                data += temp
             return data
+        # no positional read, own handle for each read
+        with open(fd.name, "rb") as f:
+            f.seek(st)
+            return f.read(ln)
+
+    def map_files(self, func, fnames, workers = None, view = False):
+        # call func(fname, data) from thread pool, results in fnames order
+        def work(fname):
+            return func(fname, self.read_file(fname, view))
+        with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+            return list(ex.map(work, fnames))
+
+    def copy_store(self, fnum, st, ln, path):
+        # copy store record to file, kernel side copy if possible
+        with open(path, "wb") as f:
+            if ln == 0:
+                return
+            if hasattr(os, "copy_file_range"):
+                src = self.strfd[fnum][0].fileno()
+                pos = 0
+                try:
+                    while pos < ln:
+                        sz = os.copy_file_range(src, f.fileno(), ln - pos,
+                            st + pos)
+                        if sz == 0: break
+                        pos += sz
+                except OSError:
+                    pass
+                if pos == ln:
+                    return
+                f.seek(0)
+                f.truncate()
+            mm = self.strmm[fnum]
+            if mm:
+                f.write(mm[1][st:st + ln])
+                return
+            for pos in range(0, ln, COPY_CHUNK):
+                f.write(self.read_store(fnum, st + pos,
+                    min(COPY_CHUNK, ln - pos)))
+
+    def extract_store(self, stid, dest, workers = None, callback = None):
+        # extract store records into dest folder, return files and bytes
+        # callback(fname, ln) called from worker threads
+        strlst = sorted(self.strfd[stid][3], key = lambda x: x[2])
+        paths = []
+        dirs = set()
+        for fname, _, _, _ in strlst:
+            elems = [x for x in fname.split("/") if x not in ("", ".", "..")]
+            np = os.path.join(dest, *elems)
+            paths.append(np)
+            dirs.add(os.path.dirname(np))
+        # create folders tree once
+        for bn in sorted(dirs):
+            os.makedirs(bn, exist_ok = True)
+        def work(idx):
+            fname, _, st, ln = strlst[idx]
+            self.copy_store(stid, st, ln, paths[idx])
+            if callback:
+                callback(fname, ln)
+            return ln
+        # records queued in offset order
+        with concurrent.futures.ThreadPoolExecutor(workers) as ex:
+            total = sum(ex.map(work, range(len(strlst))))
+        return len(strlst), total
+
+    def file_key(self, fname):
+        # identity of file content: store record or disk file with mtime
+        sf = fname.lower().replace("\\", "/")
+        if sf in self.strtable:
+            fnum, st, ln = self.strtable[sf]
+            return (self.strfd[fnum][0].name, st, ln)
+        pf = self.find_path(fname)
+        if pf is None:
+            return None
+        st = os.stat(pf)
+        return (pf, st.st_mtime_ns, st.st_size)
 
-    def read_file_stream(self, fname):
+    def file_stamp(self, fname):
+        # file_key with size and mtime of containing store
+        key = self.file_key(fname)
+        sf = fname.lower().replace("\\", "/")
+        if key and sf in self.strtable:
+            st = os.fstat(self.strfd[self.strtable[sf][0]][0].fileno())
+            key += (st.st_mtime_ns, st.st_size)
+        return key
+
+    def read_file_stream(self, fname, view = False):
+        # view - MemStream over memoryview instead of BytesIO copy
+        if view:
+            return MemStream(self.read_file(fname, True))
         data = self.read_file(fname)
         mems = io.BytesIO()
         mems.write(data)
@@ -108,24 +383,159 @@ class FileManager:
         else:
             return self.find_path(fname) is not None
 
-    def unload_stores(self, flt = None):
+    def detach_stores(self, flt = None):
+        # remove stores from tables with handles open, for attach_stores
         strfd = []
+        strmm = []
         strtable = {}
         strtableord = []
+        stores = []
         for idx, (fd, name, tag, strlst) in enumerate(self.strfd):
+            mm = self.strmm[idx]
             if flt is not None:
                 if tag != flt:
-                    for k, v in self.strtable.items():
-                        if v[0] == idx:
-                            strtable[k] = (len(strfd), v[1], v[2])
-                            strtableord.append(k)
-                    strfd.append((fd, name, tag, strlst))
+                    # store owns exactly records from strlst
+                    nstrlst = []
+                    for k, _, st, ln in strlst:
+                        strtable[k] = (len(strfd), st, ln)
+                        nstrlst.append((k, len(strtableord), st, ln))
+                        strtableord.append(k)
+                    strfd.append((fd, name, tag, nstrlst))
+                    strmm.append(mm)
+                    continue
+            stores.append(((fd, name, tag, strlst), mm))
+        self.strfd = strfd
+        self.strmm = strmm
+        self.strtable = strtable
+        self.strtableord = strtableord
+        return stores
+
+    def attach_stores(self, stores):
+        # add detached stores back, loaded records have priority
+        for (fd, name, tag, strlst), mm in stores:
+            nstrlst = []
+            for k, _, st, ln in strlst:
+                if k in self.strtable:
                     continue
+                self.strtable[k] = (len(self.strfd), st, ln)
+                nstrlst.append((k, len(self.strtableord), st, ln))
+                self.strtableord.append(k)
+            self.strfd.append((fd, name, tag, nstrlst))
+            self.strmm.append(mm)
+
+    def close_stores(self, stores):
+        for (fd, name, tag, strlst), mm in stores:
             print("DEBUG: Unload store \"{}\"".format(name))
+            try:
+                if mm:
+                    mm[1].release()
+                    # fails while returned views alive, closed by gc then
+                    mm[0].close()
+            except Exception as e:
+                print("DEBUG: Can't unmap \"{}\":".format(name) + str(e))
             try:
                 if fd: fd.close()
             except Exception as e:
                 print("DEBUG: Can't unload \"{}\":".format(name) + str(e))
-        self.strfd = strfd
-        self.strtable = strtable
-        self.strtableord = strtableord
+
+    def unload_stores(self, flt = None):
+        self.close_stores(self.detach_stores(flt))
+
+# streaming STR writer: header, data blocks, then index table and names
+class StoreWriter:
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self.index = {}
+        self.f = open(path, "wb")
+        # index ref patched in close()
+        self.f.write(b"StOR" + struct.pack("<I", 0))
+        self.pos = 8
+
+    def exists(self, fname):
+        return fname.lower().replace("\\", "/") in self.index
+
+    def add_record(self, fname, st, ln):
+        # same name added again override previous record
+        sf = fname.lower().replace("\\", "/")
+        try:
+            name = fname.replace("/", "\\").encode("latin-1")
+        except UnicodeEncodeError:
+            raise EngineError("Bad file name \"{}\" for store \"{}\"".\
+                format(fname, self.path))
+        if sf in self.index:
+            self.records[self.index[sf]] = (name, st, ln)
+        else:
+            self.index[sf] = len(self.records)
+            self.records.append((name, st, ln))
+
+    def add_stream(self, fname, f, ln = None):
+        # copy from file object by chunks, ln = None - until EOF
+        st = self.pos
+        while ln is None or self.pos - st < ln:
+            sz = COPY_CHUNK
+            if ln is not None:
+                sz = min(sz, ln - (self.pos - st))
+            data = f.read(sz)
+            if not data: break
+            self.f.write(data)
+            self.pos += len(data)
+        if ln is not None and self.pos - st != ln:
+            raise EngineError("Unexpected end of data for \"{}\"".\
+                format(fname))
+        self.add_record(fname, st, self.pos - st)
+
+    def add_data(self, fname, data):
+        self.f.write(data)
+        self.add_record(fname, self.pos, len(data))
+        self.pos += len(data)
+
+    def add_file(self, fname, path):
+        with open(path, "rb") as f:
+            self.add_stream(fname, f)
+
+    def add_store(self, fman, stid, skip = True):
+        # copy records from loaded store, skip - keep already added records
+        # records copied as is, original name case lost in FileManager
+        for fname, _, st, ln in sorted(fman.strfd[stid][3],
+                key = lambda x: x[2]):
+            if skip and self.exists(fname):
+                continue
+            start = self.pos
+            for pos in range(0, ln, COPY_CHUNK):
+                data = fman.read_store(stid, st + pos,
+                    min(COPY_CHUNK, ln - pos))
+                self.f.write(data)
+                self.pos += len(data)
+            self.add_record(fname, start, ln)
+
+    def close(self):
+        # index: count, (name offset, pos, len) records, names block
+        if self.f is None: return
+        index_ref = self.pos
+        hdr = struct.Struct("<III")
+        table = bytearray(4 + hdr.size * len(self.records))
+        struct.pack_into("<I", table, 0, len(self.records))
+        npos = 0
+        for idx, (name, st, ln) in enumerate(self.records):
+            hdr.pack_into(table, 4 + idx * hdr.size, npos, st, ln)
+            npos += len(name) + 1
+        self.f.write(table)
+        self.f.write(b"".join(name + b"\x00" for name, _, _ in self.records))
+        self.f.seek(4)
+        self.f.write(struct.pack("<I", index_ref))
+        self.f.close()
+        self.f = None
+        return len(self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # drop incomplete store
+            self.f.close()
+            self.f = None
+            os.remove(self.path)
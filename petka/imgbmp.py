@@ -5,18 +5,45 @@
 import array, struct, io
 
 from . import EngineError
+from .fman import bytes_stream
 
 try:
     from PIL import Image
 except ImportError:
     Image = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# RGB565 translate tables for each byte of pixel
+RGB565_RB_LO = bytes((x << 3) & 0b11111000 for x in range(256))
+RGB565_RB_HI = bytes(x & 0b11111000 for x in range(256))
+RGB565_G_LO = bytes((x >> 3) & 0b00011100 for x in range(256))
+RGB565_G_HI = bytes((x << 5) & 0b11100000 for x in range(256))
+
 class BMPLoader:
     def __init__(self):
         self.rgb = None
         self.image = None
         self.width = 0
         self.height = 0
+        self.depth = 0
+
+    def load_header(self, f):
+        # headers only, return True if internal 16 bit format
+        temp = f.read(62)
+        if len(temp) < 54 or temp[:2] != b"BM":
+            raise EngineError("Bad magic string")
+        f_sz, res1, res2, data_offset = struct.unpack_from("<IHHI", temp, 2)
+        pict = struct.unpack_from("<IiiHHIIiiII", temp, 14)
+        if pict[0] != 40:
+            raise EngineError("Unsupported InfoHeader")
+        self.width = pict[1]
+        self.height = pict[2]
+        self.depth = pict[4]
+        return data_offset == 40 + 6 + 8
 
     def load_data_int16(self, f):
         # check magic string "BM"
@@ -69,44 +96,63 @@ class BMPLoader:
 
         return pictw, picth, picture_data
 
+    def pixelconv16(self, pw, ph, pd, swap, ud):
+        # convert 16 bit RGB565 to 24 bit by whole buffer operations
+        # swap - pixel bytes swapped, ud - vertical reverse
+        # lo, hi - first and second byte of each pixel
+        if numpy:
+            arr = numpy.frombuffer(pd, dtype = numpy.uint8, count = pw * ph * 2)
+            arr = arr.reshape(ph, pw, 2)
+            if ud:
+                arr = arr[::-1]
+            lo = arr[:, :, 0]
+            hi = arr[:, :, 1]
+            if swap:
+                lo, hi = hi, lo
+            rgb = numpy.empty((ph, pw, 3), dtype = numpy.uint8)
+            # b16 = lo | hi << 8
+            rgb[:, :, 0] = hi & 0b11111000
+            rgb[:, :, 1] = ((lo >> 3) & 0b00011100) | ((hi << 5) & 0b11100000)
+            rgb[:, :, 2] = (lo << 3) & 0b11111000
+            if swap:
+                rgb = rgb[:, :, ::-1]
+            return array.array("B", rgb.tobytes())
+        pd = bytes(pd[:pw * ph * 2])
+        if ud:
+            row = pw * 2
+            pd = b"".join([pd[j * row:(j + 1) * row] \
+                for j in range(ph - 1, -1, -1)])
+        lo = pd[0::2]
+        hi = pd[1::2]
+        if swap:
+            lo, hi = hi, lo
+        cnt = pw * ph
+        g = int.from_bytes(lo.translate(RGB565_G_LO), "little") | \
+            int.from_bytes(hi.translate(RGB565_G_HI), "little")
+        rgb = bytearray(cnt * 3)
+        rgb[0::3] = hi.translate(RGB565_RB_HI)
+        rgb[1::3] = g.to_bytes(cnt, "little")
+        rgb[2::3] = lo.translate(RGB565_RB_LO)
+        if swap:
+            rgb[0::3], rgb[2::3] = rgb[2::3], rgb[0::3]
+        return array.array("B", rgb)
+
     def pixelswap16ud(self, pw, ph, pd):
         # convert 16 bit to 24 + vertical reverse
-        b16arr = array.array("H") # unsigned short
-        b16arr.frombytes(pd)
-        b16arr.byteswap()
-        rgb = array.array("B", [0] * pw * ph * 3)
-        for j in range(ph):
-            for i in range(pw):
-                off = (ph - j - 1) * pw * 3 + i * 3
-                b16 = b16arr[j * pw + i]
-                rgb[off] = (b16 << 3) & 0b11111000
-                rgb[off + 1] = (b16 >> 3) & 0b11111100
-                rgb[off + 2] = (b16 >> 8) & 0b11111000
-        return rgb
+        return self.pixelconv16(pw, ph, pd, True, True)
 
     def pixelswap16(self, pw, ph, pd):
         # convert 16 bit to 24
-        b16arr = array.array("H") # unsigned short
-        b16arr.frombytes(pd)
-        #b16arr.byteswap()
-        rgb = array.array("B", [0] * pw * ph * 3)
-        for j in range(ph):
-            for i in range(pw):
-                off = j * pw * 3 + i * 3
-                b16 = b16arr[j * pw + i]
-                rgb[off + 2] = (b16 << 3) & 0b11111000
-                rgb[off + 1] = (b16 >> 3) & 0b11111100
-                rgb[off + 0] = (b16 >> 8) & 0b11111000
-        return rgb
+        return self.pixelconv16(pw, ph, pd, False, False)
 
     def load_info(self, f):
         try:
-            pw, ph, pd = self.load_data_int16(f)
-            self.width = pw
-            self.height = ph
+            if self.load_header(f):
+                return
         except:
-            f.seek(0)
-            self.image = Image.open(f)
+            pass
+        f.seek(0)
+        self.image = Image.open(bytes_stream(f))
 
     def load_raw(self, pw, ph, pd):
         if Image:
@@ -129,4 +175,4 @@ class BMPLoader:
                 self.rgb = self.pixelswap16(pw, ph, pd)
         except:
             f.seek(0)
-            self.image = Image.open(f)
+            self.image = Image.open(bytes_stream(f))
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# romiq.kh@gmail.com, 2014
+
+import collections
+import threading
+import mmap
+
+# buffer is view into mmaped store
+def is_mapped(buf):
+    return isinstance(buf, memoryview) and isinstance(buf.obj, mmap.mmap)
+
+# decoded image memory estimate in bytes
+def image_size(obj):
+    size = 0
+    if obj.image is not None:
+        size += obj.image.size[0] * obj.image.size[1] * \
+            len(obj.image.getbands())
+    if obj.rgb is not None:
+        size += len(obj.rgb)
+    dec = getattr(obj, "decoder", None)
+    if dec is not None:
+        size += len(dec.pixels) + len(dec.chunks) * dec.chunks.itemsize
+        # whole file kept for seek, counted if not in mmaped store
+        if not is_mapped(dec.data):
+            size += len(dec.data)
+        for pixels, palette in dec.snapshots.values():
+            size += len(pixels) + len(palette)
+    return size
+
+# LRU of decoded images limited by total size
+class ImageCache:
+    def __init__(self, budget = 64 << 20):
+        self.budget = budget
+        self.items = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key is None or key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key][0]
+
+    def put(self, key, obj, size = None):
+        if key is None: return
+        if size is None:
+            size = image_size(obj)
+        with self.lock:
+            if key in self.items:
+                self.size -= self.items.pop(key)[1]
+            # bigger than budget - not cached
+            if size > self.budget: return
+            self.items[key] = (obj, size)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, sz) = self.items.popitem(last = False)
+                self.size -= sz
+
+    def drop_mapped(self):
+        # remove images which hold views into mmaped stores, they keep
+        # stores mapped after unload
+        with self.lock:
+            for key, (obj, size) in list(self.items.items()):
+                dec = getattr(obj, "decoder", None)
+                if dec is not None and is_mapped(dec.data):
+                    del self.items[key]
+                    self.size -= size
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
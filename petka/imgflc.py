@@ -5,6 +5,7 @@
 import array, struct, io
 
 from . import EngineError
+from .fman import bytes_stream
 
 try:
     from PIL import Image
@@ -44,6 +45,270 @@ FLC_HEADER = [
     ["reserved3",   40, "s", False],
 ]
 
+FLC_HEADER_KEYS = [hnam for hnam, _, _, _ in FLC_HEADER]
+FLC_HEADER_STRUCT = struct.Struct("<" + "".join([htp if hsz == 1 else \
+    "{}{}".format(hsz, htp) for _, hsz, htp, _ in FLC_HEADER]))
+
+# chunk types
+FLC_COLOR_256 = 0x4
+FLC_DELTA_FLC = 0x7
+FLC_COLOR_64  = 0xb
+FLC_DELTA_FLI = 0xc
+FLC_BLACK     = 0xd
+FLC_BYTE_RUN  = 0xf
+FLC_COPY      = 0x10
+FLC_PSTAMP    = 0x12
+FLC_PREFIX    = 0xF100
+FLC_FRAME     = 0xF1FA
+
+# frames between decoded state snapshots
+FLC_KEYFRAMES = 16
+
+def parse_header(data):
+    # FLC header from first 128 bytes
+    if len(data) < 128:
+        raise EngineError("FLC header truncated")
+    hdr = FLC_HEADER_STRUCT.unpack_from(data)
+    header = dict(zip(FLC_HEADER_KEYS, hdr))
+    if header["ftype"] != 0xAF12:
+        raise EngineError("Unsupported FLC type (0x{:04x})".format(
+            header["ftype"]))
+    # check if not EGI ext
+    if header["creator"] == 0x45474900:
+        if header["ext_flags"] != 0:
+            raise EngineError("Unsupported FLC EGI extension")
+    return header
+
+class FLCDecoder:
+    # index frames once, decode on seek from nearest snapshot
+    def __init__(self, f):
+        self.data = f.read()
+        self.header = parse_header(self.data)
+        self.width = self.header["width"]
+        self.height = self.header["height"]
+        self.delay = self.header["speed"]
+        # frame N chunks are chunks[frames[N] * 3:frames[N + 1] * 3]
+        # as (type, data offset, data size) triplets
+        self.chunks = array.array("I")
+        self.frames = array.array("I")
+        self.delays = array.array("H")
+        self.build_index()
+        self.frame_num = min(self.header["frames_num"], len(self.delays))
+        self.snapshots = {}
+        self.reset()
+
+    def build_index(self):
+        data = self.data
+        limit = min(self.header["fsize"], len(data))
+        offset = 128
+        while offset + 6 <= limit:
+            sz, tp = struct.unpack_from("<IH", data, offset)
+            if sz < 6 or offset + sz > limit:
+                raise EngineError("Incorrect FLC chunk at 0x{:08x}".format(
+                    offset))
+            if tp == FLC_FRAME:
+                if sz < 16:
+                    raise EngineError("Incorrect FLC FRAME_TYPE chunk at "\
+                        "0x{:08x}".format(offset))
+                sub_num, delay = struct.unpack_from("<2H", data, offset + 6)
+                self.frames.append(len(self.chunks) // 3)
+                self.delays.append(delay)
+                soff = offset + 16
+                for i in range(sub_num):
+                    if soff + 6 > offset + sz:
+                        break
+                    ssz, stp = struct.unpack_from("<IH", data, soff)
+                    if ssz < 6 or soff + ssz > offset + sz:
+                        raise EngineError("Incorrect FLC chunk at "\
+                            "0x{:08x}".format(soff))
+                    if stp == FLC_PSTAMP:
+                        # mailformed PSTAMP, drop it with previous chunks
+                        del self.chunks[self.frames[-1] * 3:]
+                    else:
+                        self.chunks.extend((stp, soff + 6, ssz - 6))
+                    soff += ssz
+            elif tp != FLC_PREFIX:
+                raise EngineError("Unknown FLC chunk type 0x{:04x} at "\
+                    "0x{:08x}".format(tp, offset))
+            offset += sz
+        self.frames.append(len(self.chunks) // 3)
+
+    def reset(self):
+        # state before first frame
+        self.frame = -1
+        self.pixels = bytearray(self.width * self.height)
+        # grayscale as in PIL for colors not set by palette chunks
+        self.palette = bytearray([c for c in range(256) for i in range(3)])
+
+    def seek(self, frame):
+        if frame < 0 or frame >= self.frame_num:
+            raise EngineError("FLC frame {} out of range".format(frame))
+        if frame < self.frame or frame - self.frame > FLC_KEYFRAMES:
+            key = frame - frame % FLC_KEYFRAMES
+            while key > 0 and key not in self.snapshots:
+                key -= FLC_KEYFRAMES
+            if key > self.frame or frame < self.frame:
+                if key in self.snapshots:
+                    pixels, palette = self.snapshots[key]
+                    self.frame = key
+                    self.pixels = bytearray(pixels)
+                    self.palette = bytearray(palette)
+                else:
+                    self.reset()
+        while self.frame < frame:
+            self.decode_frame(self.frame + 1)
+            self.frame += 1
+            if self.frame % FLC_KEYFRAMES == 0 and \
+                    self.frame not in self.snapshots:
+                self.snapshots[self.frame] = (bytes(self.pixels),
+                    bytes(self.palette))
+
+    def decode_frame(self, frame):
+        chunks = self.chunks
+        size = self.width * self.height
+        for idx in range(self.frames[frame] * 3, self.frames[frame + 1] * 3,
+                3):
+            tp, off, sz = chunks[idx], chunks[idx + 1], chunks[idx + 2]
+            if tp == FLC_COLOR_256:
+                self.decode_color(off, 0)
+            elif tp == FLC_COLOR_64:
+                self.decode_color(off, 2)
+            elif tp == FLC_BYTE_RUN:
+                self.decode_byte_run(off)
+            elif tp == FLC_DELTA_FLC:
+                self.decode_delta_flc(off)
+            elif tp == FLC_DELTA_FLI:
+                self.decode_delta_fli(off)
+            elif tp == FLC_BLACK:
+                self.pixels[:] = bytes(len(self.pixels))
+            elif tp == FLC_COPY:
+                ln = len(self.pixels)
+                if sz < ln:
+                    raise EngineError("FLC COPY chunk truncated")
+                self.pixels[:] = self.data[off:off + ln]
+            else:
+                raise EngineError("Unsupported FLC chunk type 0x{:04x}".\
+                    format(tp))
+            # drop writes out of frame
+            del self.pixels[size:]
+
+    def decode_color(self, off, shift):
+        data = self.data
+        pal = self.palette
+        num = struct.unpack_from("<H", data, off)[0]
+        off += 2
+        idx = 0
+        for i in range(num):
+            idx += data[off]
+            cnt = data[off + 1] or 256
+            off += 2
+            cnt = min(cnt, 256 - idx)
+            if shift:
+                pal[idx * 3:(idx + cnt) * 3] = bytes([(x << shift) & 0xff \
+                    for x in data[off:off + cnt * 3]])
+            else:
+                pal[idx * 3:(idx + cnt) * 3] = data[off:off + cnt * 3]
+            off += cnt * 3
+            idx += cnt
+
+    def decode_byte_run(self, off):
+        data = self.data
+        pix = self.pixels
+        w = self.width
+        for y in range(self.height):
+            # packets count ignored, run until line filled
+            off += 1
+            pos = y * w
+            end = pos + w
+            while pos < end:
+                cnt = data[off]
+                if cnt < 128:
+                    pix[pos:pos + cnt] = bytes((data[off + 1],)) * cnt
+                    off += 2
+                else:
+                    cnt = 256 - cnt
+                    pix[pos:pos + cnt] = data[off + 1:off + 1 + cnt]
+                    off += cnt + 1
+                pos += cnt
+
+    def decode_delta_flc(self, off):
+        data = self.data
+        pix = self.pixels
+        w = self.width
+        lines = struct.unpack_from("<H", data, off)[0]
+        off += 2
+        y = 0
+        for i in range(lines):
+            # opcodes until packet count
+            while True:
+                op = struct.unpack_from("<h", data, off)[0]
+                off += 2
+                if op >= 0:
+                    break
+                if op & 0x4000:
+                    # skip lines
+                    y -= op
+                else:
+                    # last pixel of line
+                    if y < self.height:
+                        pix[y * w + w - 1] = op & 0xff
+            pos = y * w
+            for j in range(op):
+                pos += data[off]
+                cnt = data[off + 1]
+                if cnt < 128:
+                    cnt *= 2
+                    pix[pos:pos + cnt] = data[off + 2:off + 2 + cnt]
+                    off += cnt + 2
+                else:
+                    cnt = 256 - cnt
+                    pix[pos:pos + cnt * 2] = \
+                        bytes(data[off + 2:off + 4]) * cnt
+                    cnt *= 2
+                    off += 4
+                pos += cnt
+            y += 1
+
+    def decode_delta_fli(self, off):
+        data = self.data
+        pix = self.pixels
+        w = self.width
+        y, lines = struct.unpack_from("<2H", data, off)
+        off += 4
+        for i in range(lines):
+            pos = (y + i) * w
+            num = data[off]
+            off += 1
+            for j in range(num):
+                pos += data[off]
+                cnt = data[off + 1]
+                if cnt < 128:
+                    pix[pos:pos + cnt] = data[off + 2:off + 2 + cnt]
+                    off += cnt + 2
+                else:
+                    cnt = 256 - cnt
+                    pix[pos:pos + cnt] = bytes((data[off + 2],)) * cnt
+                    off += 3
+                pos += cnt
+
+    def frame_rgb(self):
+        # current frame as 24 bit RGB
+        pix = bytes(self.pixels)
+        pal = bytes(self.palette)
+        rgb = bytearray(len(pix) * 3)
+        rgb[0::3] = pix.translate(pal[0::3])
+        rgb[1::3] = pix.translate(pal[1::3])
+        rgb[2::3] = pix.translate(pal[2::3])
+        return rgb
+
+    def frame_image(self):
+        # current frame as PIL palette image
+        image = Image.frombytes("P", (self.width, self.height),
+            bytes(self.pixels))
+        image.putpalette(bytes(self.palette))
+        image.info["duration"] = self.delay
+        return image
+
 class FLCLoader:
     def __init__(self):
         self.rgb = None
@@ -52,10 +317,32 @@ class FLCLoader:
         self.height = 0
         self.frame_num = 0
         self.delay = 0
+        self.decoder = None
 
+    def load_header(self, f):
+        # 128 bytes header only
+        header = parse_header(f.read(128))
+        self.width = header["width"]
+        self.height = header["height"]
+        self.frame_num = header["frames_num"]
+        self.delay = header["speed"]
+
+    def load_decoder(self, f):
+        self.decoder = FLCDecoder(f)
+        self.width = self.decoder.width
+        self.height = self.decoder.height
+        self.frame_num = self.decoder.frame_num
+        self.delay = self.decoder.delay
 
     def load_info(self, f):
-        self.image = Image.open(f)
+        # frames index only, no pixels decoded
+        try:
+            self.load_decoder(f)
+            return
+        except:
+            if not Image: raise
+            f.seek(0)
+        self.image = Image.open(bytes_stream(f))
         self.frame_num = 1
         try:
             while 1:
@@ -140,38 +427,28 @@ class FLCLoader:
 
         return offset, chunks
 
-    def load_data(self, f):
-        # parse header
-        offset = 0
-        hdr_keys = []
-        hdr_struct = "<"
-        for hnam, hsz, htp, hed in FLC_HEADER:
-            hdr_keys.append(hnam)
-            if hsz == 1:
-                hdr_struct += htp
-            else:
-                hdr_struct += "%d" % hsz + htp
-
-        header = {}
-        temp = f.read(128)
-        hdr = struct.unpack_from(hdr_struct, temp)
-
-        offset += 128
-
-        if len(hdr) != len(hdr_keys):
-            raise EngineError("Incorrect FLC header {} != {}".format(
-                len(hdr), len(hdr_keys)))
-        for hid in range(len(hdr)):
-            header[hdr_keys[hid]] = hdr[hid]
+    def load_frame(self, frame):
+        self.decoder.seek(frame)
+        if Image:
+            self.image = self.decoder.frame_image()
+        else:
+            self.rgb = self.decoder.frame_rgb()
 
-        if header["ftype"] != 0xAF12:
-            raise EngineError("Unsupported FLC type (0x{:04x})".format(
-                header["ftype"]))
+    def load_data(self, f):
+        try:
+            self.load_decoder(f)
+            self.load_frame(0)
+            return
+        except:
+            if not Image: raise
+            self.decoder = None
+            f.seek(0)
+        self.load_data_pil(f)
 
-        # check if not EGI ext
-        if header["creator"] == 0x45474900:
-            if header["ext_flags"] != 0:
-                raise EngineError("Unsupported FLC EGI extension")
+    def load_data_pil(self, f):
+        # parse header
+        offset = 128
+        header = parse_header(f.read(128))
 
         # NOTE: we recreate FLC to avoid Pilllow bug
         #  1. remove 0xf100 chunk  (PREFIX, implementation specific)
@@ -9,6 +9,17 @@ from . import EngineError
 class LEGLoader:
     def __init__(self):
         self.coords = []
+        self.frame_num = 0
+
+    def load_header(self, f):
+        # magic and size only
+        hdr = f.read(4)
+        if hdr != b"xyof":
+            raise EngineError("Bad LEG/OFF magic \"{}\"".format(bytes(hdr)))
+        size = f.seek(0, 2) - 4
+        if size % 8:
+            raise EngineError("Bad LEG/OFF size {}".format(size))
+        self.frame_num = size // 8
 
     def load_info(self, f):
         return self.load_data(f)
@@ -16,7 +27,7 @@ class LEGLoader:
     def load_data(self, f):
         hdr = f.read(4)
         if hdr != b"xyof":
-            raise EngineError("Bad LEG/OFF magic \"{}\"".format(hdr))
+            raise EngineError("Bad LEG/OFF magic \"{}\"".format(bytes(hdr)))
 
         rest = f.read()
         if len(rest) % 8:
@@ -24,3 +35,4 @@ class LEGLoader:
 
         sf = struct.unpack("<{}l".format(len(rest) // 4), rest)
         self.coords = [[sf[i * 2], sf[i * 2 + 1]] for i in range(len(rest) // 8)]
+        self.frame_num = len(self.coords)
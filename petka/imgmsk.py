@@ -10,6 +10,27 @@ class MSKLoader:
     def __init__(self):
         self.bound = [0, 0, 0, 0]
         self.rects = []
+        self.rect_num = 0
+
+    def load_header(self, f):
+        # walk records by counts only, read bound
+        size = f.seek(0, 2)
+        f.seek(0)
+        delta = size - 16
+        num = 0
+        while delta > 0:
+            temp = f.read(4)
+            if len(temp) != 4:
+                raise EngineError("Bad MSK file")
+            rects_len = struct.unpack_from("<I", temp)[0]
+            f.seek(rects_len * 8, 1)
+            delta -= 4 + rects_len * 8 + 4
+            num += 1
+        if delta != 0:
+           raise EngineError("Bad MSK file")
+        f.seek(size - 16)
+        self.bound = struct.unpack_from("<4i", f.read(16))
+        self.rect_num = num
 
     def load_info(self, f):
         return self.load_data(f)
@@ -45,3 +66,4 @@ class MSKLoader:
         self.bound = struct.unpack_from("<4i", temp)
 
         self.rects = list(zip(reversed(frms), rects))
+        self.rect_num = len(self.rects)